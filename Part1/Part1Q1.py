@@ -1,5 +1,16 @@
+import itertools
+import math
 import multiprocessing as mp
+import os
 import time
+from array import array
+from functools import partial
+
+# Size (in numbers, one byte each) of a sieve window; small enough to stay in L2 cache
+SEGMENT_SIZE = 1 << 18
+
+# Number of scheduler tasks handed out per worker; higher values balance better
+TASKS_PER_CORE = 16
 
 
 # Function to check if a number is prime
@@ -12,27 +23,205 @@ def is_prime(n):
     return True
 
 
-# Function to process a chunk of data (find prime numbers)
-def process_chunk(data_chunk):
-    return [n for n in data_chunk if is_prime(n)]
+# Function to find prime numbers in [start, end) by trial division
+def trial_division_find_primes(start, end):
+    return [n for n in range(start, end) if is_prime(n)]
+
+
+# Function to compute all primes up to limit (inclusive) with a plain sieve
+def base_primes(limit):
+    if limit < 2:
+        return []
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[0:2] = b"\x00\x00"
+    for p in range(2, math.isqrt(limit) + 1):
+        if sieve[p]:
+            sieve[p * p :: p] = bytes(len(range(p * p, limit + 1, p)))
+    return list(itertools.compress(range(limit + 1), sieve))
+
+
+# Function to sieve one window [lo, hi) (lo >= 2) with precomputed base primes
+def sieve_segment(lo, hi, primes):
+    segment = bytearray([1]) * (hi - lo)
+    for p in primes:
+        if p * p >= hi:
+            break
+        # First multiple of p inside the window, never below p*p
+        first = max(p * p, (lo + p - 1) // p * p)
+        segment[first - lo :: p] = bytes(len(range(first - lo, hi - lo, p)))
+    return segment
+
+
+# Function to yield (lo, hi, segment) sieve windows covering [start, end) in order;
+# only one window is held in memory at a time
+def iter_sieve_segments(start, end, segment_size=SEGMENT_SIZE):
+    start = max(start, 2)
+    if start >= end:
+        return
+    # Base primes are computed once up to sqrt(end) and reused for every window
+    primes = base_primes(math.isqrt(end - 1))
+    for lo in range(start, end, segment_size):
+        hi = min(lo + segment_size, end)
+        yield lo, hi, sieve_segment(lo, hi, primes)
+
+
+# Streaming API: yield the primes in [start, end) in order, segment by segment
+def iter_primes(start, end, segment_size=SEGMENT_SIZE):
+    for lo, hi, segment in iter_sieve_segments(start, end, segment_size):
+        yield from itertools.compress(range(lo, hi), segment)
+
+
+# Function to count the primes in [start, end) without materializing them
+def count_primes(start, end, segment_size=SEGMENT_SIZE):
+    return sum(
+        segment.count(1)
+        for _, _, segment in iter_sieve_segments(start, end, segment_size)
+    )
+
+
+# Segmented Sieve of Eratosthenes over [start, end), window by window
+def sieve_find_primes(start, end, segment_size=SEGMENT_SIZE):
+    result = []
+    for lo, hi, segment in iter_sieve_segments(start, end, segment_size):
+        result.extend(itertools.compress(range(lo, hi), segment))
+    return result
+
+
+# Function to reduce a sequence of primes to a (count, sum, sum of squares) checksum,
+# kept modulo 2**64; it replaces building two sets to compare large results
+def prime_checksum(primes):
+    count = total = squares = 0
+    for p in primes:
+        count += 1
+        total += p
+        squares += p * p
+    mask = (1 << 64) - 1
+    return count, total & mask, squares & mask
+
+
+# Available prime search engines, all sharing the (start, end) contract
+ENGINES = {
+    "trial": trial_division_find_primes,
+    "sieve": sieve_find_primes,
+}
+
+
+# Function to pick the most compact array typecode able to hold every number below end
+def prime_typecode(end):
+    return "I" if end <= 2**32 else "Q"
+
+
+# Function to process a range of numbers [lo, hi) (find prime numbers)
+# Workers only receive the bounds and send back a compact array instead of a list,
+# together with their pid and the time they spent busy on the task. The typecode is
+# the one of the whole range, so every result can extend the parent's array
+def process_range(bounds, engine="sieve", typecode="Q"):
+    lo, hi = bounds
+    task_start = time.perf_counter()
+    primes = array(typecode, ENGINES[engine](lo, hi))
+    return lo, os.getpid(), time.perf_counter() - task_start, primes
+
+
+# Estimated cumulative cost of scanning [0, n): trial division costs ~sqrt(n) per
+# number, the sieve a roughly constant amount per number
+ENGINE_COST_EXPONENT = {
+    "trial": 1.5,
+    "sieve": 1.0,
+}
+
+
+# Function to split [start, end) into up to num_tasks contiguous (lo, hi) bounds of
+# roughly equal estimated cost, so tasks at high n are narrower than at low n
+def split_range(start, end, num_tasks, engine="sieve"):
+    num_tasks = max(1, min(num_tasks, end - start))
+    exponent = ENGINE_COST_EXPONENT[engine]
+    cost_start = max(start, 0) ** exponent
+    cost_end = max(end, 0) ** exponent
+    bounds = [start]
+    for i in range(1, num_tasks):
+        cost = cost_start + (cost_end - cost_start) * i / num_tasks
+        boundary = int(round(cost ** (1 / exponent)))
+        if bounds[-1] < boundary < end:
+            bounds.append(boundary)
+    bounds.append(end)
+    return list(zip(bounds, bounds[1:]))
 
 
 # Multi-threaded approach using multiprocessing
-def parallel_find_primes(start, end, num_cores):
-    data = list(range(start, end))
-    chunk_size = len(data) // num_cores
-    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+# Many small cost-weighted tasks are dispatched with imap_unordered so idle workers
+# keep pulling work; pass a dict as stats to get the per-worker busy time back
+def parallel_find_primes(
+    start, end, num_cores, engine="sieve", tasks_per_core=TASKS_PER_CORE, stats=None
+):
+    if num_cores < 1:
+        raise ValueError("num_cores must be at least 1")
+    if tasks_per_core < 1:
+        raise ValueError("tasks_per_core must be at least 1")
+
+    # Nothing below 2 is prime, so the degenerate part of the range is skipped
+    start = max(start, 2)
+    typecode = prime_typecode(end)
+    primes = array(typecode)
+    tasks = (
+        split_range(start, end, num_cores * tasks_per_core, engine)
+        if start < end
+        else []
+    )
+    worker_busy = {}
+    # A short range may split into fewer tasks than cores
+    processes = min(num_cores, len(tasks))
+
+    wall_start = time.perf_counter()
+    if tasks:
+        with mp.Pool(processes) as pool:
+            # Results arrive out of order; hold them until the next range is complete
+            pending = {}
+            next_index = 0
+            task_index = {lo: i for i, (lo, _) in enumerate(tasks)}
+            for lo, pid, busy, result in pool.imap_unordered(
+                partial(process_range, engine=engine, typecode=typecode), tasks
+            ):
+                worker_busy[pid] = worker_busy.get(pid, 0.0) + busy
+                pending[task_index[lo]] = result
+                while next_index in pending:
+                    primes.extend(pending.pop(next_index))
+                    next_index += 1
+    wall = time.perf_counter() - wall_start
+
+    if stats is not None:
+        stats.update(
+            {
+                "engine": engine,
+                "num_cores": num_cores,
+                "processes": processes,
+                "tasks": len(tasks),
+                "wall": wall,
+                "worker_busy": worker_busy,
+                # Share of the pool's process time spent doing useful work
+                "efficiency": (
+                    sum(worker_busy.values()) / (wall * processes)
+                    if wall and processes
+                    else 0.0
+                ),
+            }
+        )
+    return primes
 
-    with mp.Pool(num_cores) as pool:
-        results = pool.map(process_chunk, chunks)
 
-    primes = [item for sublist in results for item in sublist]
-    return primes
+# Function to print the per-worker busy time collected by parallel_find_primes
+def print_worker_report(stats):
+    print(
+        f"{stats['tasks']} tasks on {stats['processes']} processes "
+        f"({stats['engine']}), wall {stats['wall']:.2f} seconds, "
+        f"efficiency {stats['efficiency']:.0%}"
+    )
+    for pid, busy in sorted(stats["worker_busy"].items()):
+        print(f"  worker {pid}: busy {busy:.2f} seconds")
 
 
 # Single-threaded approach to find prime numbers
-def single_thread_find_primes(start, end):
-    primes = [n for n in range(start, end) if is_prime(n)]
+def single_thread_find_primes(start, end, engine="sieve"):
+    primes = ENGINES[engine](start, end)
     return primes
 
 
@@ -49,12 +238,16 @@ if __name__ == "__main__":
     # Measure time for multi-threaded approach
     num_cores = mp.cpu_count()
     start_time = time.time()
-    multi_thread_primes = parallel_find_primes(start_num, end_num, num_cores)
+    stats = {}
+    multi_thread_primes = parallel_find_primes(
+        start_num, end_num, num_cores, stats=stats
+    )
     multi_thread_duration = time.time() - start_time
 
-    assert set(single_thread_primes) == set(
+    assert prime_checksum(single_thread_primes) == prime_checksum(
         multi_thread_primes
     ), "Single-threaded and multi-threaded results do not match"
 
     print(f"Single-threaded duration: {single_thread_duration:.2f} seconds")
     print(f"Multi-threaded duration: {multi_thread_duration:.2f} seconds")
+    print_worker_report(stats)
@@ -0,0 +1,222 @@
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+from Part1Q1 import (
+    parallel_find_primes,
+    prime_checksum,
+    single_thread_find_primes,
+)
+
+# The shared benchmark helpers live at the repository root (see the README)
+from benchmarking import (
+    find_regressions,
+    parse_int_list,
+    run_isolated,
+    summarize_timings,
+)
+from instrumentation import peak_rss_mb
+
+# Columns written to the CSV report, in order
+REPORT_FIELDS = [
+    "label",
+    "engine",
+    "mode",
+    "size",
+    "workers",
+    "repeats",
+    "median",
+    "p95",
+    "min",
+    "mean",
+    "speedup",
+    "efficiency",
+    "peak_rss_mb",
+    "worker_peak_rss_mb",
+    "prime_count",
+]
+
+
+# Function to run one benchmark case once and return its result checksum
+def run_case(engine, mode, size, workers):
+    start, end = 2, 2 + size
+    if mode == "single":
+        primes = single_thread_find_primes(start, end, engine=engine)
+    else:
+        primes = parallel_find_primes(start, end, workers, engine=engine)
+    return prime_checksum(primes)
+
+
+# Function executed in a fresh child process so peak RSS is measured per case
+def measure_case(engine, mode, size, workers, warmup, repeats):
+    for _ in range(warmup):
+        run_case(engine, mode, size, workers)
+
+    timings = []
+    checksum = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        checksum = run_case(engine, mode, size, workers)
+        timings.append(time.perf_counter() - start_time)
+
+    return {
+        "timings": timings,
+        "prime_count": checksum[0],
+        "peak_rss_mb": peak_rss_mb(),
+        "worker_peak_rss_mb": peak_rss_mb(children=True),
+    }
+
+
+# Function to run a case in its own process and summarise its timings
+def benchmark_case(engine, mode, size, workers, warmup, repeats):
+    measured = run_isolated(
+        measure_case,
+        (engine, mode, size, workers, warmup, repeats),
+        f"{engine} {mode} size={size} workers={workers}",
+    )
+    return {
+        "engine": engine,
+        "mode": mode,
+        "size": size,
+        "workers": workers,
+        **summarize_timings(measured["timings"]),
+        "peak_rss_mb": measured["peak_rss_mb"],
+        "worker_peak_rss_mb": measured["worker_peak_rss_mb"],
+        "prime_count": measured["prime_count"],
+    }
+
+
+# Function to sweep every engine, range size and worker count
+def run_benchmarks(engines, sizes, worker_counts, warmup, repeats, label):
+    results = []
+    for engine in engines:
+        for size in sizes:
+            baseline = benchmark_case(engine, "single", size, 1, warmup, repeats)
+            baseline.update({"speedup": 1.0, "efficiency": 1.0})
+            cases = [baseline]
+            for workers in worker_counts:
+                case = benchmark_case(
+                    engine, "parallel", size, workers, warmup, repeats
+                )
+                # Speedup and parallel efficiency relative to the single-threaded run
+                case["speedup"] = baseline["median"] / case["median"]
+                case["efficiency"] = case["speedup"] / workers
+                cases.append(case)
+
+            for case in cases:
+                case["label"] = label
+                if case["prime_count"] != baseline["prime_count"]:
+                    raise RuntimeError(
+                        f"{engine} {case['mode']} with {case['workers']} workers "
+                        f"found {case['prime_count']} primes, "
+                        f"expected {baseline['prime_count']}"
+                    )
+                print(
+                    f"{engine:>6} {case['mode']:>8} size={size:<12} "
+                    f"workers={case['workers']:<3} median={case['median']:.4f}s "
+                    f"p95={case['p95']:.4f}s speedup={case['speedup']:.2f} "
+                    f"efficiency={case['efficiency']:.0%} "
+                    f"rss={case['peak_rss_mb']:.1f}MB"
+                )
+            results.extend(cases)
+    return results
+
+
+# Function to key a case by engine, mode, range size and worker count
+def case_key(case):
+    return case["engine"], case["mode"], case["size"], case["workers"]
+
+
+# Function to load the cases of a previous JSON report, to flag regressions against
+def load_baseline(path):
+    with open(path) as f:
+        return {case_key(case): case for case in json.load(f)["results"]}
+
+
+# Function to write the results as a JSON report with machine metadata
+def write_json(results, path, label):
+    report = {
+        "label": label,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": mp.cpu_count(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"JSON report saved to {path}")
+
+
+# Function to write the results as a flat CSV report
+def write_csv(results, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    print(f"CSV report saved to {path}")
+
+
+def default_worker_counts():
+    counts = []
+    workers = 2
+    while workers < mp.cpu_count():
+        counts.append(workers)
+        workers *= 2
+    return counts + [mp.cpu_count()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Part1Q1 prime search engines."
+    )
+    parser.add_argument("--engines", default="trial,sieve")
+    parser.add_argument(
+        "--sizes", type=parse_int_list, default=[10**5, 10**6], help="e.g. 1e5,1e6"
+    )
+    parser.add_argument("--workers", type=parse_int_list, default=None)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--label", default="local", help="version or commit label")
+    parser.add_argument("--json", dest="json_path")
+    parser.add_argument("--csv", dest="csv_path")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="allowed slowdown of the median before a case counts as a regression",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.engines.split(","),
+        args.sizes,
+        args.workers or default_worker_counts(),
+        args.warmup,
+        args.repeats,
+        args.label,
+    )
+
+    if args.json_path:
+        write_json(results, args.json_path, args.label)
+    if args.csv_path:
+        write_csv(results, args.csv_path)
+
+    if args.baseline:
+        regressions = find_regressions(
+            results, load_baseline(args.baseline), case_key, args.threshold
+        )
+        for case, old in regressions:
+            print(
+                f"Regression: {case['engine']} {case['mode']} size={case['size']} "
+                f"workers={case['workers']} median {old['median']:.4f}s -> "
+                f"{case['median']:.4f}s"
+            )
+        if regressions:
+            sys.exit(1)
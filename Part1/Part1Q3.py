@@ -1,30 +1,277 @@
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock, ContentSettings
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import json
 import os
+import time
 from dotenv import load_dotenv
 
-load_dotenv()
+from azure_clients import get_blob_service_client
 
-# Retrieve values from environment variables
-connection_string = os.getenv("AZURE_CONNECTION_STRING")
-container_name = os.getenv("AZURE_CONTAINER_NAME")
-file_path = os.getenv("AZURE_FILE_PATH")
-blob_name = os.path.basename(file_path)
+# Defaults for the block upload mode, overridable from the .env file
+BLOCK_SIZE_MB = 8
+MAX_CONCURRENCY = 8
+SYNC_WORKERS = 8
 
-# Initialize the BlobServiceClient
-blob_service_client = BlobServiceClient.from_connection_string(connection_string)
 
-# Check if the container exists, create if it doesn't
-container_client = blob_service_client.get_container_client(container_name)
-if not container_client.exists():
-    container_client.create_container()
-    print(f'New container "{container_name}" created.')
+def get_container_client(blob_service_client, container_name):
+    # Check if the container exists, create if it doesn't
+    container_client = blob_service_client.get_container_client(container_name)
+    if not container_client.exists():
+        container_client.create_container()
+        print(f'New container "{container_name}" created.')
+    return container_client
 
-# Upload the file
-blob_client = blob_service_client.get_blob_client(
-    container=container_name, blob=blob_name
-)
 
-with open(file_path, "rb") as data:
-    blob_client.upload_blob(data, overwrite=True)
+def upload_file(blob_client, file_path, content_settings=None):
+    # Upload the whole file in a single call using the SDK defaults
+    with open(file_path, "rb") as data:
+        blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
 
-print(f"File {file_path} uploaded to container {container_name} as blob {blob_name}.")
+
+def block_ids_for(file_path, block_size):
+    # Block ids must all have the same length. They embed a fingerprint of the file
+    # and the block size, so blocks staged for another version of the file are
+    # never reused when resuming.
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}:{block_size}"
+    fingerprint = hashlib.sha1(key.encode()).hexdigest()[:16]
+    num_blocks = -(-stat.st_size // block_size)
+    return [f"{fingerprint}-{index:08d}" for index in range(num_blocks)]
+
+
+def get_staged_blocks(blob_client):
+    # Uncommitted blocks left behind by an interrupted upload, keyed by id
+    try:
+        _, uncommitted = blob_client.get_block_list("uncommitted")
+    except ResourceNotFoundError:
+        return {}
+    return {block.id: block.size for block in uncommitted}
+
+
+def upload_file_in_blocks(
+    blob_client,
+    file_path,
+    block_size=BLOCK_SIZE_MB * 1024 * 1024,
+    max_concurrency=MAX_CONCURRENCY,
+    content_settings=None,
+    executor=None,
+):
+    """
+    Uploads a file as concurrently staged blocks followed by a single commit.
+    Blocks already staged by a previous, interrupted run are not uploaded again.
+    The blocks are staged on executor when given, e.g. one shared by several files,
+    otherwise on a pool of max_concurrency threads.
+    """
+    file_size = os.path.getsize(file_path)
+    block_ids = block_ids_for(file_path, block_size)
+    staged = get_staged_blocks(blob_client)
+
+    missing = []
+    for index, block_id in enumerate(block_ids):
+        length = min(block_size, file_size - index * block_size)
+        if staged.get(block_id) != length:
+            missing.append((block_id, index * block_size, length))
+
+    def stage(block):
+        block_id, offset, length = block
+        # Each block is read on its own so at most max_concurrency blocks are in memory
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        blob_client.stage_block(block_id, data, length=length)
+        return length
+
+    start_time = time.perf_counter()
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            uploaded_bytes = sum(executor.map(stage, missing))
+    else:
+        uploaded_bytes = sum(executor.map(stage, missing))
+    blob_client.commit_block_list(
+        [BlobBlock(block_id=block_id) for block_id in block_ids],
+        content_settings=content_settings,
+    )
+    duration = time.perf_counter() - start_time
+
+    throughput = uploaded_bytes / (1024 * 1024) / duration if duration else 0.0
+    print(
+        f"Staged {len(missing)} of {len(block_ids)} blocks "
+        f"({uploaded_bytes / (1024 * 1024):.1f} MB) in {duration:.2f} seconds, "
+        f"{throughput:.1f} MB/s."
+    )
+    return uploaded_bytes
+
+
+def file_md5(file_path, chunk_size=4 * 1024 * 1024):
+    # MD5 digest of a local file, read in chunks to keep memory flat
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def load_digest_cache(cache_path):
+    # MD5 digests of the previous syncs by absolute path, each with the size and
+    # mtime of the file it was taken from
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_digest_cache(cache_path, digests):
+    # Written to a temporary file first so an interrupted run never corrupts it
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(digests, f)
+    os.replace(tmp_path, cache_path)
+
+
+def sync_directory(
+    container_client,
+    pattern,
+    base_dir=".",
+    prefix="",
+    upload_mode="single",
+    max_workers=SYNC_WORKERS,
+    block_size=BLOCK_SIZE_MB * 1024 * 1024,
+    max_concurrency=MAX_CONCURRENCY,
+    digest_cache=None,
+):
+    """
+    Uploads every file matching the glob pattern through one container client,
+    skipping files whose MD5 matches the content hash of the existing blob. Only
+    files of the same size as their blob are hashed for the comparison, and with
+    digest_cache the digests are kept in that JSON file and reused while a file's
+    size and mtime are unchanged. In block mode all files stage their blocks on one
+    shared pool of max_concurrency threads, so at most max_workers + max_concurrency
+    threads run.
+    """
+    cache_path = os.path.abspath(digest_cache) if digest_cache else None
+    file_paths = [
+        path
+        for path in glob.glob(os.path.join(base_dir, pattern), recursive=True)
+        if os.path.isfile(path) and os.path.abspath(path) != cache_path
+    ]
+
+    # One listing call returns the size and content hash of every remote blob
+    remote_blobs = {
+        blob.name: (blob.size, blob.content_settings.content_md5)
+        for blob in container_client.list_blobs(name_starts_with=prefix or None)
+    }
+    digests = load_digest_cache(cache_path)
+
+    def cached_md5(file_path, stat):
+        key = os.path.abspath(file_path)
+        entry = digests.get(key)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return bytes.fromhex(entry[2])
+        md5 = file_md5(file_path)
+        digests[key] = [stat.st_size, stat.st_mtime_ns, md5.hex()]
+        return md5
+
+    def sync(file_path):
+        relative_path = os.path.relpath(file_path, base_dir).replace(os.sep, "/")
+        blob_name = f"{prefix}{relative_path}"
+        stat = os.stat(file_path)
+        remote_size, remote_md5 = remote_blobs.get(blob_name, (None, None))
+        # A missing blob or one of another size has changed, whatever its hash
+        if (
+            remote_size == stat.st_size
+            and remote_md5
+            and cached_md5(file_path, stat) == bytes(remote_md5)
+        ):
+            return False
+        md5 = cached_md5(file_path, stat)
+
+        # Store the MD5 explicitly; block and chunked uploads don't set it on their own
+        content_settings = ContentSettings(content_md5=bytearray(md5))
+        blob_client = container_client.get_blob_client(blob_name)
+        if upload_mode == "blocks":
+            upload_file_in_blocks(
+                blob_client,
+                file_path,
+                block_size,
+                content_settings=content_settings,
+                executor=block_executor,
+            )
+        else:
+            upload_file(blob_client, file_path, content_settings)
+        return True
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as block_executor:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            uploaded = sum(executor.map(sync, file_paths))
+    duration = time.perf_counter() - start_time
+
+    if cache_path:
+        # Entries of deleted files are dropped
+        save_digest_cache(
+            cache_path,
+            {path: entry for path, entry in digests.items() if os.path.exists(path)},
+        )
+
+    print(
+        f"Synced {len(file_paths)} files in {duration:.2f} seconds: "
+        f"{uploaded} uploaded, {len(file_paths) - uploaded} unchanged."
+    )
+    return uploaded
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    # Retrieve values from environment variables
+    connection_string = os.getenv("AZURE_CONNECTION_STRING")
+    container_name = os.getenv("AZURE_CONTAINER_NAME")
+    file_path = os.getenv("AZURE_FILE_PATH")
+    # When set, every file matching the glob is synced instead of AZURE_FILE_PATH
+    sync_pattern = os.getenv("AZURE_SYNC_PATTERN")
+    sync_dir = os.getenv("AZURE_SYNC_DIR", ".")
+    sync_prefix = os.getenv("AZURE_SYNC_PREFIX", "")
+    sync_workers = int(os.getenv("AZURE_SYNC_WORKERS", SYNC_WORKERS))
+    # MD5 digests reused across syncs while a file's size and mtime are unchanged
+    # (disabled when empty)
+    sync_digest_cache = os.getenv("AZURE_SYNC_DIGEST_CACHE", "sync_digests.json")
+    # "single" uploads with one upload_blob call, "blocks" stages blocks concurrently
+    upload_mode = os.getenv("AZURE_UPLOAD_MODE", "single")
+    block_size_mb = int(os.getenv("AZURE_BLOCK_SIZE_MB", BLOCK_SIZE_MB))
+    max_concurrency = int(os.getenv("AZURE_MAX_CONCURRENCY", MAX_CONCURRENCY))
+
+    # Initialize the BlobServiceClient, pooled through the shared client factory
+    # (a local emulator such as Azurite works with "UseDevelopmentStorage=true")
+    blob_service_client = get_blob_service_client(connection_string=connection_string)
+    container_client = get_container_client(blob_service_client, container_name)
+
+    if sync_pattern:
+        sync_directory(
+            container_client,
+            sync_pattern,
+            sync_dir,
+            sync_prefix,
+            upload_mode,
+            sync_workers,
+            block_size_mb * 1024 * 1024,
+            max_concurrency,
+            sync_digest_cache or None,
+        )
+    else:
+        # Upload the file
+        blob_name = os.path.basename(file_path)
+        blob_client = container_client.get_blob_client(blob_name)
+        if upload_mode == "blocks":
+            upload_file_in_blocks(
+                blob_client, file_path, block_size_mb * 1024 * 1024, max_concurrency
+            )
+        else:
+            upload_file(blob_client, file_path)
+
+        print(
+            f"File {file_path} uploaded to container {container_name} "
+            f"as blob {blob_name}."
+        )
@@ -1,70 +1,422 @@
-from azure.identity import DefaultAzureCredential
 from azure.mgmt.monitor import MonitorManagementClient
-from datetime import datetime, timedelta
+from azure.mgmt.monitor.models import EventData
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import csv
+import heapq
+import json
+import re
+import time
 from dotenv import load_dotenv
 import os
 
-load_dotenv()
+from azure_clients import get_mgmt_client
+from instrumentation import add_metrics, stage, start_run
 
-# Initialize credentials and MonitorManagementClient
-credential = DefaultAzureCredential()
-subscription_id = os.getenv(
-    "SUBSCRIPTION_ID"
-)  # Replace with your Azure subscription ID
-monitor_client = MonitorManagementClient(credential, subscription_id)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = pq = None
 
-# Define the time range for the Activity Logs (e.g., last 1 day)
-start_time = datetime.now() - timedelta(days=1)
-end_time = datetime.now()
+# Header row of the exported CSV file
+CSV_HEADER = [
+    "Correlation id",
+    "Operation name",
+    "Status",
+    "Event category",
+    "Level",
+    "Time",
+    "Subscription",
+    "Event initiated by",
+    "Resource type",
+    "Resource group",
+    "Resource",
+]
 
-# Define the resource you want to filter (e.g., specific resource name or resource ID)
-resource_id = os.getenv("RESOURCE_ID")
+# Rows accumulated per column before a Parquet row group is written
+PARQUET_BATCH_SIZE = 50000
 
-# Query Activity Logs for the specific resource
-activity_logs = monitor_client.activity_logs.list(
-    filter=f"eventTimestamp ge '{start_time}' and eventTimestamp le '{end_time}' and resourceId eq '{resource_id}')"
-)
 
-# Define a CSV file to store the logs
-csv_file = "activity_logs.csv"
+def build_filter(start_time, end_time, resource_id):
+    # OData filter for the Activity Logs of a specific resource in a time range
+    return f"eventTimestamp ge '{start_time}' and eventTimestamp le '{end_time}' and resourceId eq '{resource_id}')"
 
-# Write the logs to a CSV file
-with open(csv_file, mode="w", newline="") as file:
-    writer = csv.writer(file)
-    # Write header row to match the format you showed
-    writer.writerow(
+
+def fetch_activity_logs(monitor_client, start_time, end_time, resource_id):
+    # Query Activity Logs for the specific resource; pages are fetched lazily
+    return monitor_client.activity_logs.list(
+        filter=build_filter(start_time, end_time, resource_id)
+    )
+
+
+def split_time_range(start_time, end_time, windows):
+    # Split [start_time, end_time] into consecutive sub-windows of equal length
+    windows = max(1, windows)
+    step = (end_time - start_time) / windows
+    bounds = [start_time + step * i for i in range(windows)] + [end_time]
+    return list(zip(bounds, bounds[1:]))
+
+
+def event_sort_key(log):
+    return log.event_timestamp.timestamp() if log.event_timestamp else 0.0
+
+
+def event_key(log):
+    # Events on a window boundary are returned by both windows (ge/le filters)
+    return log.correlation_id, log.event_data_id
+
+
+def export_activity_logs_parallel(
+    monitor_client, start_time, end_time, resource_id, windows=4, workers=4
+):
+    """
+    Fetches the Activity Logs of [start_time, end_time] as `windows` sub-windows
+    queried by at most `workers` threads, merged in timestamp order and deduplicated.
+    """
+
+    def fetch_window(window):
+        window_start, window_end = window
+        logs = list(
+            fetch_activity_logs(monitor_client, window_start, window_end, resource_id)
+        )
+        logs.sort(key=event_sort_key)
+        return logs
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        window_logs = list(
+            executor.map(fetch_window, split_time_range(start_time, end_time, windows))
+        )
+
+    seen = set()
+    merged = []
+    for log in heapq.merge(*window_logs, key=event_sort_key):
+        key = event_key(log)
+        if key not in seen:
+            seen.add(key)
+            merged.append(log)
+    return merged
+
+
+def log_to_row(log):
+    return [
+        log.correlation_id,
+        log.operation_name.localized_value if log.operation_name else None,
+        log.status.localized_value if log.status else None,
+        log.category.value if log.category else None,
+        log.level if log.level else None,
+        log.event_timestamp.isoformat() if log.event_timestamp else None,
+        log.subscription_id,
+        log.caller,
+        log.resource_type.value if log.resource_type else None,
+        log.resource_group_name,
+        log.resource_id,
+    ]
+
+
+def write_logs_to_csv(activity_logs, csv_file):
+    # Write the logs to a CSV file
+    with open(csv_file, mode="w", newline="") as file:
+        writer = csv.writer(file)
+        # Write header row to match the format you showed
+        writer.writerow(CSV_HEADER)
+
+        # Write log data
+        rows = 0
+        for log in activity_logs:
+            writer.writerow(log_to_row(log))
+            rows += 1
+    return rows
+
+
+def write_logs_to_parquet(activity_logs, parquet_file, batch_size=PARQUET_BATCH_SIZE):
+    # Write the logs to a dictionary-encoded, compressed Parquet file. Values are
+    # accumulated per column and written as one row group per batch.
+    if pq is None:
+        raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+
+    schema = pa.schema(
         [
-            "Correlation id",
-            "Operation name",
-            "Status",
-            "Event category",
-            "Level",
-            "Time",
-            "Subscription",
-            "Event initiated by",
-            "Resource type",
-            "Resource group",
-            "Resource",
+            (name, pa.timestamp("us", tz="UTC") if name == "Time" else pa.string())
+            for name in CSV_HEADER
         ]
     )
+    time_index = CSV_HEADER.index("Time")
+    columns = [[] for _ in CSV_HEADER]
+
+    def write_batch(writer):
+        writer.write_table(
+            pa.Table.from_arrays(
+                [pa.array(column, type=f.type) for column, f in zip(columns, schema)],
+                schema=schema,
+            )
+        )
+        for column in columns:
+            column.clear()
+
+    with pq.ParquetWriter(
+        parquet_file, schema, compression="zstd", use_dictionary=True
+    ) as writer:
+        batches = rows = 0
+        for log in activity_logs:
+            rows += 1
+            row = log_to_row(log)
+            row[time_index] = log.event_timestamp
+            for column, value in zip(columns, row):
+                column.append(value)
+            if len(columns[0]) >= batch_size:
+                write_batch(writer)
+                batches += 1
+        if columns[0] or not batches:
+            write_batch(writer)
+    return rows
+
+
+def write_logs(activity_logs, output_file, output_format="csv"):
+    # Returns the number of logs written
+    if output_format == "parquet":
+        return write_logs_to_parquet(activity_logs, output_file)
+    return write_logs_to_csv(activity_logs, output_file)
+
+
+def rotate_file(path, backup_count):
+    # Shift path -> path.1 -> path.2 ... dropping the oldest, like RotatingFileHandler
+    for index in range(backup_count - 1, 0, -1):
+        if os.path.exists(f"{path}.{index}"):
+            os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+    if backup_count > 0:
+        os.replace(path, f"{path}.1")
+    else:
+        os.remove(path)
+
+
+def append_logs_to_csv(activity_logs, csv_file, max_bytes, backup_count):
+    # Append the logs to a CSV file that is rotated once it reaches max_bytes;
+    # returns the number of bytes written
+    if os.path.exists(csv_file) and os.path.getsize(csv_file) >= max_bytes:
+        rotate_file(csv_file, backup_count)
+
+    write_header = not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0
+    with open(csv_file, mode="a", newline="") as file:
+        start_offset = file.tell()
+        writer = csv.writer(file)
+        if write_header:
+            writer.writerow(CSV_HEADER)
+        for log in activity_logs:
+            writer.writerow(log_to_row(log))
+        return file.tell() - start_offset
+
+
+def load_checkpoint(checkpoint_path):
+    # High-water-mark timestamp and recently seen event ids of the previous run
+    if not os.path.exists(checkpoint_path):
+        return None, set()
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    high_water_mark = datetime.fromisoformat(checkpoint["high_water_mark"])
+    return high_water_mark, {tuple(key) for key in checkpoint["recent_ids"]}
+
+
+def save_checkpoint(checkpoint_path, high_water_mark, recent_ids):
+    # Written to a temporary file first so an interrupted run never corrupts it
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "high_water_mark": high_water_mark.isoformat(),
+                "recent_ids": sorted(list(key) for key in recent_ids),
+            },
+            f,
+        )
+    os.replace(tmp_path, checkpoint_path)
+
+
+def collect_incremental(
+    monitor_client,
+    resource_id,
+    checkpoint_path,
+    csv_file,
+    initial_window=timedelta(days=1),
+    overlap=timedelta(minutes=5),
+    max_bytes=100 * 1024 * 1024,
+    backup_count=5,
+    windows=1,
+    workers=4,
+):
+    """
+    Fetches only the events newer than the checkpointed high-water-mark and appends
+    them to a rotating CSV file. The query reaches back `overlap` before the mark to
+    pick up late-arriving events; the ids kept from that span filter out repeats.
+    """
+    end_time = datetime.now(timezone.utc)
+    high_water_mark, recent_ids = load_checkpoint(checkpoint_path)
+    if high_water_mark is None:
+        start_time = end_time - initial_window
+    else:
+        start_time = high_water_mark - overlap
+
+    if windows > 1:
+        fetched = export_activity_logs_parallel(
+            monitor_client, start_time, end_time, resource_id, windows, workers
+        )
+    else:
+        fetched = sorted(
+            fetch_activity_logs(monitor_client, start_time, end_time, resource_id),
+            key=event_sort_key,
+        )
+
+    new_logs = [log for log in fetched if event_key(log) not in recent_ids]
+    bytes_written = append_logs_to_csv(new_logs, csv_file, max_bytes, backup_count)
+    add_metrics(bytes=bytes_written, rows=len(new_logs))
+
+    timestamps = [log.event_timestamp for log in fetched if log.event_timestamp]
+    if timestamps:
+        high_water_mark = max([high_water_mark or timestamps[0]] + timestamps)
+    elif high_water_mark is None:
+        high_water_mark = end_time
+    # Only ids that a later overlap query can return again need to be kept
+    recent_ids = {
+        event_key(log)
+        for log in fetched
+        if log.event_timestamp and log.event_timestamp >= high_water_mark - overlap
+    }
+    save_checkpoint(checkpoint_path, high_water_mark, recent_ids)
+
+    print(
+        f"{len(new_logs)} new activity logs appended to {csv_file} "
+        f"({bytes_written} bytes), high-water-mark {high_water_mark}"
+    )
+    return new_logs
+
+
+def record_activity_logs(activity_logs, fixture_path):
+    # Save fetched events as a JSON fixture for RecordedMonitorClient
+    with open(fixture_path, "w") as f:
+        json.dump([log.as_dict() for log in activity_logs], f)
+
+
+class RecordedActivityLogs:
+    """
+    Offline stand-in for `monitor_client.activity_logs` that serves events from a
+    JSON fixture, honouring the time range of the filter and paging like the API.
+    """
+
+    def __init__(self, events, page_size=200, page_latency=0.0):
+        self.events = events
+        self.page_size = page_size
+        self.page_latency = page_latency
+
+    @staticmethod
+    def parse_time(value):
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-    # Write log data
-    for log in activity_logs:
-        writer.writerow(
-            [
-                log.correlation_id,
-                log.operation_name.localized_value if log.operation_name else None,
-                log.status.localized_value if log.status else None,
-                log.category.value if log.category else None,
-                log.level if log.level else None,
-                log.event_timestamp.isoformat() if log.event_timestamp else None,
-                log.subscription_id,
-                log.caller,
-                log.resource_type.value if log.resource_type else None,
-                log.resource_group_name,
-                log.resource_id,
-            ]
+    def list(self, filter):
+        start_time, end_time = (
+            self.parse_time(value)
+            for value in re.findall(r"eventTimestamp [gl]e '([^']*)'", filter)
         )
+        matching = [
+            event
+            for event in self.events
+            if event.event_timestamp and start_time <= event.event_timestamp <= end_time
+        ]
+        # Like the service, newest events come first
+        matching.sort(key=event_sort_key, reverse=True)
+        return self.pages(matching)
+
+    def pages(self, events):
+        for offset in range(0, len(events), self.page_size):
+            # Simulated round trip for each page
+            time.sleep(self.page_latency)
+            yield from events[offset : offset + self.page_size]
+
+
+class RecordedMonitorClient:
+    """
+    Offline stand-in for MonitorManagementClient backed by a recorded fixture.
+    """
+
+    def __init__(self, fixture_path, page_size=200, page_latency=0.0):
+        with open(fixture_path) as f:
+            events = [EventData.from_dict(event) for event in json.load(f)]
+        self.activity_logs = RecordedActivityLogs(events, page_size, page_latency)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    subscription_id = os.getenv(
+        "SUBSCRIPTION_ID"
+    )  # Replace with your Azure subscription ID
+    # Number of sub-windows the time range is split into, and how many run at once
+    windows = int(os.getenv("ACTIVITY_LOG_WINDOWS", 1))
+    workers = int(os.getenv("ACTIVITY_LOG_WORKERS", 4))
+    # Serve events from a recorded JSON fixture instead of the live API
+    fixture_path = os.getenv("ACTIVITY_LOG_FIXTURE")
+    # Incremental mode appends only new events, tracked by a checkpoint file
+    incremental = os.getenv("ACTIVITY_LOG_INCREMENTAL", "false").lower() == "true"
+    checkpoint_path = os.getenv(
+        "ACTIVITY_LOG_CHECKPOINT", "activity_logs.checkpoint.json"
+    )
+    max_bytes = int(os.getenv("ACTIVITY_LOG_MAX_MB", 100)) * 1024 * 1024
+    # "csv" or "parquet" for full exports; incremental runs always append to CSV
+    output_format = os.getenv("ACTIVITY_LOG_FORMAT", "csv")
+    backup_count = int(os.getenv("ACTIVITY_LOG_BACKUPS", 5))
+    # Timings, bytes, rows and memory of the export, written as JSON to RUN_REPORT
+    run_report_path = os.getenv("RUN_REPORT")
+    report = start_run(
+        "Part1Q4",
+        os.getenv("RUN_PROFILE") or None,
+        os.getenv("RUN_PROFILE_DIR", "profiles"),
+    )
+
+    # Initialize credentials and MonitorManagementClient
+    if fixture_path:
+        monitor_client = RecordedMonitorClient(fixture_path)
+    else:
+        monitor_client = get_mgmt_client(MonitorManagementClient, subscription_id)
+
+    # Define the time range for the Activity Logs (e.g., last 1 day)
+    start_time = datetime.now() - timedelta(days=1)
+    end_time = datetime.now()
+
+    # Define the resource you want to filter (e.g., specific resource name or resource ID)
+    resource_id = os.getenv("RESOURCE_ID")
+
+    # Define a CSV file to store the logs
+    csv_file = "activity_logs.csv"
+    output_file = "activity_logs.parquet" if output_format == "parquet" else csv_file
+
+    export_start = time.perf_counter()
+    with stage("export_activity_logs") as metrics:
+        if incremental:
+            collect_incremental(
+                monitor_client,
+                resource_id,
+                checkpoint_path,
+                csv_file,
+                max_bytes=max_bytes,
+                backup_count=backup_count,
+                windows=windows,
+                workers=workers,
+            )
+        else:
+            if windows > 1:
+                activity_logs = export_activity_logs_parallel(
+                    monitor_client, start_time, end_time, resource_id, windows, workers
+                )
+            else:
+                activity_logs = fetch_activity_logs(
+                    monitor_client, start_time, end_time, resource_id
+                )
+            metrics["rows"] = write_logs(activity_logs, output_file, output_format)
+            metrics["bytes"] = os.path.getsize(output_file)
+
+    print(
+        f"Activity logs saved to {csv_file if incremental else output_file} "
+        f"in {time.perf_counter() - export_start:.2f} seconds"
+    )
 
-print(f"Activity logs saved to {csv_file}")
+    if run_report_path:
+        report.write(run_report_path)
@@ -1,34 +1,231 @@
+import argparse
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import math
+import multiprocessing
 import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network.models import NetworkInterfaceIPConfiguration
-from azure.mgmt.storage.models import VirtualNetworkRule
 
-from azure.storage.blob import BlobServiceClient
-import pandas as pd
-
-
-def initialize_clients(subscription_id, resource_group_name, location):
+# The Azure SDKs, numpy and pandas are imported inside the functions that use them,
+# so each command only pays for the modules it needs
+from azure_clients import get_blob_service_client, get_credential, get_mgmt_client
+from instrumentation import add_metrics, stage, start_run
+
+# Stages of the pipeline, each runnable as its own command, and the heavy modules
+# each one needs; they are imported up front so their import time is recorded
+COMMAND_IMPORTS = {
+    "provision": [
+        "azure.identity",
+        "azure.mgmt.network",
+        "azure.mgmt.resource",
+        "azure.mgmt.compute",
+        "azure.mgmt.storage",
+    ],
+    "fetch": ["azure.identity", "azure.storage.blob"],
+    "analyze": ["numpy", "pandas"],
+    "publish": [
+        "azure.identity",
+        "azure.storage.blob",
+        "azure.mgmt.network",
+        "azure.mgmt.resource",
+        "azure.mgmt.compute",
+        "azure.mgmt.storage",
+    ],
+}
+
+# Analysis modes that aggregate the source while downloading it, with no local copy
+STREAMING_MODES = ("stream", "blobs", "incremental")
+
+# Desired fields that the service never returns, so they can't be compared
+IGNORED_SPEC_KEYS = {"admin_password"}
+
+# Rows parsed and aggregated per chunk by the chunked and streamed analyses
+CHUNK_ROWS = 100_000
+
+# One KPI of the analysis: `agg` ("mean", "sum" or "count") of `measure` per `key`,
+# sorted in descending order and optionally limited to the `top_k` largest values
+AggregateSpec = namedtuple(
+    "AggregateSpec",
+    ["name", "key", "measure", "agg", "top_k"],
+    defaults=["Rating", "mean", None],
+)
+AGGREGATIONS = ("mean", "sum", "count")
+
+# Group sums are kept exactly, as integer multiples of 2**-EXACT_SUM_BITS (a unit
+# every float64 is a multiple of), and rounded once when the results are built.
+# They add up to the same value in any order and chunking, so every analysis mode
+# gives identical results, equal to pandas' compensated groupby means
+EXACT_SUM_BITS = 1126
+
+# The KPIs computed by analyze_df and saved to the result file
+ANALYSIS_SPECS = [
+    AggregateSpec("country_avg_rate", "Country"),
+    AggregateSpec("top_3_categories", "Category", top_k=3),
+]
+
+# Local download cache of source blobs and parallel range downloads
+DOWNLOAD_CACHE_MAX_MB = 2048
+DOWNLOAD_CONCURRENCY = 8
+
+# Per-blob partial sums and counts of the incremental mode, with the ETag each was
+# computed from; totals are summed over the blobs when the results are regenerated.
+# The exact sums are stored as decimal text; a store of another version is rebuilt
+AGGREGATE_STORE_VERSION = 2
+AGGREGATE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_blobs (
+    name TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partial_totals (
+    blob TEXT NOT NULL,
+    key TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    value TEXT NOT NULL,
+    total TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (blob, key, measure, value)
+);
+"""
+
+
+def initialize_clients(
+    subscription_id, resource_group_name, location, create_resource_group=True
+):
     """
     Initialize clients. Creates a resource group if it doesn't exist.
     """
-    credential = DefaultAzureCredential()
-    network_client = NetworkManagementClient(credential, subscription_id)
-    resource_client = ResourceManagementClient(credential, subscription_id)
-    compute_client = ComputeManagementClient(credential, subscription_id)
-    storage_client = StorageManagementClient(credential, subscription_id)
-    resource_client.resource_groups.create_or_update(
-        resource_group_name, {"location": location}
-    )
-    print(f"Resource group {resource_group_name} created or already exists.")
+    from azure.mgmt.compute import ComputeManagementClient
+    from azure.mgmt.network import NetworkManagementClient
+    from azure.mgmt.resource import ResourceManagementClient
+    from azure.mgmt.storage import StorageManagementClient
+
+    # Shared credential and pooled clients, reused by every step of the pipeline
+    credential = get_credential()
+    network_client = get_mgmt_client(NetworkManagementClient, subscription_id)
+    resource_client = get_mgmt_client(ResourceManagementClient, subscription_id)
+    compute_client = get_mgmt_client(ComputeManagementClient, subscription_id)
+    storage_client = get_mgmt_client(StorageManagementClient, subscription_id)
+    if resource_client.resource_groups.check_existence(resource_group_name):
+        print(f"Resource group {resource_group_name} already exists.")
+    elif create_resource_group:
+        resource_client.resource_groups.create_or_update(
+            resource_group_name, {"location": location}
+        )
+        print(f"Resource group {resource_group_name} created.")
     return credential, resource_client, network_client, compute_client, storage_client
 
 
-def create_vnet(network_client, resource_group_name, vnet_name, location):
+def fetch_deployed_state(
+    network_client,
+    compute_client,
+    resource_group_name,
+    vnet_name,
+    nsg_name,
+    subnet_name,
+    public_ip_name,
+    nic_name,
+    vm_name,
+):
+    """
+    GETs all resources of the deployment in parallel. Missing resources are None.
+    """
+    from azure.core.exceptions import ResourceNotFoundError
+
+    requests = {
+        "vnet": (network_client.virtual_networks.get, vnet_name),
+        "nsg": (network_client.network_security_groups.get, nsg_name),
+        "subnet": (network_client.subnets.get, vnet_name, subnet_name),
+        "public_ip": (network_client.public_ip_addresses.get, public_ip_name),
+        "nic": (network_client.network_interfaces.get, nic_name),
+        "vm": (compute_client.virtual_machines.get, vm_name),
+    }
+
+    def get(request):
+        get_func, *names = request
+        try:
+            return get_func(resource_group_name, *names)
+        except ResourceNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        return dict(zip(requests, executor.map(get, requests.values())))
+
+
+def spec_diff(actual, desired, path=""):
+    """
+    Yields (path, actual, desired) for every value of the desired params that the
+    actual resource doesn't match. Fields only set by the service are ignored.
+    """
+    if isinstance(desired, dict):
+        for key, value in desired.items():
+            if key in IGNORED_SPEC_KEYS:
+                continue
+            if isinstance(actual, dict):
+                child = actual.get(key)
+            else:
+                child = getattr(actual, key, None)
+            yield from spec_diff(child, value, f"{path}.{key}" if path else key)
+    elif isinstance(desired, list):
+        if actual is None or len(actual) != len(desired):
+            yield path, actual, desired
+        else:
+            for index, (child, value) in enumerate(zip(actual, desired)):
+                yield from spec_diff(child, value, f"{path}[{index}]")
+    elif isinstance(desired, str):
+        # Resource ids, locations and enum values are case-insensitive
+        if not isinstance(actual, str) or actual.lower() != desired.lower():
+            yield path, actual, desired
+    elif actual != desired:
+        yield path, actual, desired
+
+
+def check_existing(kind, name, existing, params, mode="apply"):
+    """
+    Compares the desired params with the existing resource and returns the resource
+    to use instead of calling begin_create_or_update, or None if the call is needed.
+    In "plan" mode nothing is changed: differences are printed and the existing
+    resource, or a placeholder for a missing one, is returned. "force" always updates.
+    """
+    if mode == "force":
+        return None
+    differences = None if existing is None else list(spec_diff(existing, params))
+    if differences == []:
+        print(f"{kind} {name} is up to date, skipped.")
+        return existing
+    if mode != "plan":
+        return None
+
+    if existing is None:
+        print(f"{kind} {name} would be created.")
+        return SimpleNamespace(id=f"<new {kind} {name}>", name=name, ip_address=None)
+    print(f"{kind} {name} would be updated:")
+    for path, actual, desired in differences:
+        print(f"  {path}: {actual!r} -> {desired!r}")
+    return existing
+
+
+def create_vnet(
+    network_client,
+    resource_group_name,
+    vnet_name,
+    location,
+    existing=None,
+    mode="apply",
+):
     """
     Creates a Virtual Network (VNet).
     """
@@ -36,6 +233,9 @@ def create_vnet(network_client, resource_group_name, vnet_name, location):
         "location": location,
         "address_space": {"address_prefixes": ["10.0.0.0/16"]},
     }
+    current = check_existing("Virtual Network", vnet_name, existing, vnet_params, mode)
+    if current is not None:
+        return current
     vnet = network_client.virtual_networks.begin_create_or_update(
         resource_group_name, vnet_name, vnet_params
     ).result()
@@ -43,11 +243,18 @@ def create_vnet(network_client, resource_group_name, vnet_name, location):
     return vnet
 
 
-def create_nsg(network_client, resource_group_name, nsg_name, location):
+def create_nsg(
+    network_client, resource_group_name, nsg_name, location, existing=None, mode="apply"
+):
     """
     Creates a Network Security Group (NSG).
     """
     nsg_params = {"location": location}
+    current = check_existing(
+        "Network Security Group", nsg_name, existing, nsg_params, mode
+    )
+    if current is not None:
+        return current
     nsg = network_client.network_security_groups.begin_create_or_update(
         resource_group_name, nsg_name, nsg_params
     ).result()
@@ -55,7 +262,15 @@ def create_nsg(network_client, resource_group_name, nsg_name, location):
     return nsg
 
 
-def create_subnet(network_client, resource_group_name, vnet_name, subnet_name, nsg):
+def create_subnet(
+    network_client,
+    resource_group_name,
+    vnet_name,
+    subnet_name,
+    nsg,
+    existing=None,
+    mode="apply",
+):
     """
     Creates a Subnet within the VNet.
     """
@@ -63,6 +278,9 @@ def create_subnet(network_client, resource_group_name, vnet_name, subnet_name, n
         "address_prefix": "10.0.0.0/24",
         "network_security_group": {"id": nsg.id},
     }
+    current = check_existing("Subnet", subnet_name, existing, subnet_params, mode)
+    if current is not None:
+        return current
     subnet = network_client.subnets.begin_create_or_update(
         resource_group_name, vnet_name, subnet_name, subnet_params
     ).result()
@@ -70,7 +288,14 @@ def create_subnet(network_client, resource_group_name, vnet_name, subnet_name, n
     return subnet
 
 
-def create_public_ip(network_client, resource_group_name, public_ip_name, location):
+def create_public_ip(
+    network_client,
+    resource_group_name,
+    public_ip_name,
+    location,
+    existing=None,
+    mode="apply",
+):
     # Create Public IP Address
     public_ip_params = {
         "location": location,
@@ -78,6 +303,11 @@ def create_public_ip(network_client, resource_group_name, public_ip_name, locati
         "sku": {"name": "Basic"},  # Basic or Standard
         "public_ip_address_version": "IPv4",
     }
+    current = check_existing(
+        "Public IP", public_ip_name, existing, public_ip_params, mode
+    )
+    if current is not None:
+        return current
     public_ip = network_client.public_ip_addresses.begin_create_or_update(
         resource_group_name, public_ip_name, public_ip_params
     ).result()
@@ -87,18 +317,34 @@ def create_public_ip(network_client, resource_group_name, public_ip_name, locati
 
 
 def create_nic(
-    network_client, resource_group_name, nic_name, public_ip, location, subnet
+    network_client,
+    resource_group_name,
+    nic_name,
+    public_ip,
+    location,
+    subnet,
+    existing=None,
+    mode="apply",
 ):
     """
     Creates a Network Interface Card (NIC) and associates it with the subnet, the public IP and NSG.
     """
-    ip_config = NetworkInterfaceIPConfiguration(
-        name="ipconfig1",
-        subnet={"id": subnet.id},
-        private_ip_allocation_method="Dynamic",
-        public_ip_address={"id": public_ip.id},
-    )
+    ip_config = {
+        "name": "ipconfig1",
+        "subnet": {"id": subnet.id},
+        "private_ip_allocation_method": "Dynamic",
+        "public_ip_address": {"id": public_ip.id},
+    }
     nic_params = {"location": location, "ip_configurations": [ip_config]}
+    current = check_existing(
+        "Network Interface Card", nic_name, existing, nic_params, mode
+    )
+    if current is not None:
+        return current
+
+    from azure.mgmt.network.models import NetworkInterfaceIPConfiguration
+
+    nic_params["ip_configurations"] = [NetworkInterfaceIPConfiguration(**ip_config)]
     nic = network_client.network_interfaces.begin_create_or_update(
         resource_group_name, nic_name, nic_params
     ).result()
@@ -116,6 +362,8 @@ def create_vm(
     nic,
     vm_username,
     vm_password,
+    existing=None,
+    mode="apply",
 ):
     """
     Creates a Virtual Machine (VM) using the NIC.
@@ -138,6 +386,9 @@ def create_vm(
         },
         "network_profile": {"network_interfaces": [{"id": nic.id}]},
     }
+    current = check_existing("Virtual Machine", vm_name, existing, vm_params, mode)
+    if current is not None:
+        return current
     vm = compute_client.virtual_machines.begin_create_or_update(
         resource_group_name, vm_name, vm_params
     ).result()
@@ -145,59 +396,881 @@ def create_vm(
     return vm
 
 
-def read_data_from_azure(
-    account_url, credential, raw_container_name, blob_name, local_file_path
+def run_dag(steps, max_workers=8):
+    """
+    Runs the steps {name: (func, [dependency names])} on a thread pool, starting each
+    step as soon as its dependencies have finished. func is called with the results of
+    its dependencies, in order. Returns the results and the (start, duration) of every
+    step in seconds since the DAG started.
+    """
+    results, timings, running = {}, {}, {}
+    pending = dict(steps)
+    dag_start = time.perf_counter()
+
+    def timed(name, func, args):
+        step_start = time.perf_counter()
+        with stage(name):
+            result = func(*args)
+        timings[name] = (step_start - dag_start, time.perf_counter() - step_start)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    args = [results[dependency] for dependency in dependencies]
+                    running[executor.submit(timed, name, func, args)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unresolvable dependencies for steps {list(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Re-raises the first failure; steps already running are left to finish
+                results[running.pop(future)] = future.result()
+
+    return results, timings
+
+
+def print_timings(timings):
+    # Per-step start offset and duration, in the order the steps started
+    print("\nStep timings (seconds):")
+    for name, (start, duration) in sorted(timings.items(), key=lambda t: t[1][0]):
+        print(f"  {name:<12} start {start:7.2f}  duration {duration:7.2f}")
+    print(f"  {'total':<12} {max(s + d for s, d in timings.values()):7.2f}")
+
+
+def import_command_modules(command):
+    # Import the heavy modules of a command, timed as a stage of its own
+    import_start = time.perf_counter()
+    with stage(f"import_{command}"):
+        for module in COMMAND_IMPORTS[command]:
+            importlib.import_module(module)
+    print(
+        f"Imported the {command} dependencies in "
+        f"{time.perf_counter() - import_start:.2f} seconds"
+    )
+
+
+def evict_download_cache(cache_dir, max_bytes, keep=None):
+    # Remove the least recently used cached blobs until the cache fits in max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".json"):
+            data_path = os.path.join(cache_dir, name[: -len(".json")])
+            if os.path.exists(data_path):
+                stat = os.stat(data_path)
+                entries.append((stat.st_mtime, stat.st_size, data_path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, data_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if data_path != keep:
+            os.remove(f"{data_path}.json")
+            os.remove(data_path)
+            total -= size
+
+
+def cached_blob_path(cache_dir, account_url, container_name, blob_name):
+    # Path of a blob's entry in the download cache, with its metadata next to it as
+    # .json; derived from the names alone so it is found without any request
+    blob_key = f"{account_url.rstrip('/')}/{container_name}/{blob_name}"
+    return os.path.join(cache_dir, hashlib.sha256(blob_key.encode()).hexdigest())
+
+
+def download_blob_cached(
+    blob_client,
+    data_path,
+    max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+    max_concurrency=DOWNLOAD_CONCURRENCY,
+):
+    """
+    Keeps a local copy of the blob at data_path, an entry of the download cache
+    (see cached_blob_path), and returns data_path. The cached copy is revalidated
+    with a conditional request on its ETag (If-None-Match), so an unchanged blob
+    costs no transfer; otherwise it is downloaded in parallel ranges.
+    """
+    from azure.core import MatchConditions
+    from azure.core.exceptions import HttpResponseError
+
+    cache_dir = os.path.dirname(data_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    blob_key = f"{blob_client.container_name}/{blob_client.blob_name}"
+    meta_path = f"{data_path}.json"
+
+    conditions = {}
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            conditions = {
+                "etag": json.load(f)["etag"],
+                "match_condition": MatchConditions.IfModified,
+            }
+
+    try:
+        downloader = blob_client.download_blob(
+            max_concurrency=max_concurrency, **conditions
+        )
+    except HttpResponseError as error:
+        # The storage SDK surfaces 304 Not Modified as a plain HttpResponseError (or
+        # ResourceModifiedError), never as ResourceNotModifiedError
+        if error.status_code != 304:
+            raise
+        # Mark as recently used for the eviction order
+        os.utime(data_path)
+        print(f"Blob {blob_key} unchanged, using cached copy {data_path}")
+        return data_path
+
+    # Download next to the cache entry first so a failed download never replaces it
+    part_path = f"{data_path}.part"
+    with open(part_path, "wb") as file:
+        add_metrics(bytes=downloader.readinto(file))
+    os.replace(part_path, data_path)
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "blob": blob_key,
+                "etag": downloader.properties.etag,
+                "size": downloader.size,
+            },
+            f,
+        )
+    print(f"Blob {blob_key} downloaded to cache {data_path}")
+
+    evict_download_cache(cache_dir, max_bytes, keep=data_path)
+    return data_path
+
+
+def download_data_from_azure(
+    account_url,
+    credential,
+    raw_container_name,
+    blob_name,
+    local_file_path,
+    cache_dir=None,
+    cache_max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+    max_concurrency=1,
 ):
+    """
+    Downloads the blob to local_file_path, or into the download cache when cache_dir
+    is set, and returns the path of the local copy.
+    """
     # Initialize the BlobServiceClient with the storage account URL and credentials
-    blob_service_client = BlobServiceClient(
-        account_url=account_url, credential=credential
-    )
+    blob_service_client = get_blob_service_client(account_url, credential)
     # Get the container client
     container_client = blob_service_client.get_container_client(raw_container_name)
 
     # Get the blob client (the CSV file)
     blob_client = container_client.get_blob_client(blob_name)
 
+    if cache_dir:
+        # Use the download cache, revalidated by ETag
+        data_path = cached_blob_path(
+            cache_dir, account_url, raw_container_name, blob_name
+        )
+        return download_blob_cached(
+            blob_client, data_path, cache_max_bytes, max_concurrency
+        )
+
     # Download the blob to a local file
     with open(local_file_path, "wb") as file:
-        blob_data = blob_client.download_blob()
-        blob_data.readinto(file)
+        blob_data = blob_client.download_blob(max_concurrency=max_concurrency)
+        add_metrics(bytes=blob_data.readinto(file))
 
     print(f"Blob downloaded to {local_file_path}")
+    return local_file_path
+
+
+def read_data_from_azure(
+    account_url,
+    credential,
+    raw_container_name,
+    blob_name,
+    local_file_path,
+    cache_dir=None,
+    cache_max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+    max_concurrency=1,
+):
+    local_file_path = download_data_from_azure(
+        account_url,
+        credential,
+        raw_container_name,
+        blob_name,
+        local_file_path,
+        cache_dir,
+        cache_max_bytes,
+        max_concurrency,
+    )
+
+    return load_data(local_file_path)
+
+
+def load_data(local_file_path):
+    import pandas as pd
 
     # Load the downloaded CSV file into a Pandas DataFrame
     df = pd.read_csv(local_file_path)
+    add_metrics(rows=len(df))
     return df
 
 
-def analyze_df(df):
-    # Group the data by 'Country' and calculate the average 'Rating'
-    country_avg_rate = df.groupby("Country")["Rating"].mean().reset_index()
+class BlobChunkStream(io.RawIOBase):
+    """
+    Read-only file object over the chunks of a blob download, so the CSV parser can
+    consume the blob while it is still arriving.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self.bytes_read += len(self._chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def analysis_columns(specs=ANALYSIS_SPECS):
+    # Columns read by the specs, to parse nothing else
+    return list(
+        dict.fromkeys(column for spec in specs for column in (spec.key, spec.measure))
+    )
+
+
+def exact_group_sums(codes, values, num_groups):
+    """
+    Exact sum of the values per group code, as an object array of Python ints in
+    units of 2**-EXACT_SUM_BITS. The 53-bit mantissas are split in two halves whose
+    sums per (group, exponent) are exact in float64 for up to 2**26 rows at a time;
+    the halves are then combined per group relative to the smallest exponent.
+    """
+    import numpy as np
+    import pandas as pd
+
+    sums = np.full(num_groups, 0, dtype=object)
+    if not len(values):
+        return sums
+    mantissas, exponents = np.frexp(values)
+    mantissas = (mantissas * 2.0**53).astype(np.int64)
+    # frexp exponents of finite floats are >= -1073, so the shifts are >= 0
+    shifts = exponents.astype(np.int64) + (EXACT_SUM_BITS - 53)
+    base = int(shifts.min())
+    width = int(shifts.max()) - base + 1
+    pair_ids = codes.astype(np.int64) * width + shifts - base
+
+    # Every (group, exponent) pair gets a dense slot unless the exponents are too
+    # spread out for that; then only the pairs that occur are numbered
+    dense = num_groups * width <= max(2 * len(values), 2**24)
+    if dense:
+        pair_codes, num_pairs = pair_ids, num_groups * width
+    else:
+        pair_codes, pairs = pd.factorize(pair_ids)
+        num_pairs = len(pairs)
+
+    high = np.zeros(num_pairs, dtype=np.int64)
+    low = np.zeros(num_pairs, dtype=np.int64)
+    for start in range(0, len(values), 2**26):
+        block = slice(start, start + 2**26)
+        for total, half in (
+            (high, mantissas[block] >> 26),
+            (low, mantissas[block] & (2**26 - 1)),
+        ):
+            total += np.bincount(
+                pair_codes[block], weights=half, minlength=num_pairs
+            ).astype(np.int64)
+
+    if dense and width < 63:
+        # The halves of each group are combined in int64 when they can't overflow
+        scale = 2.0 ** np.arange(width)
+        bound = max(
+            (np.abs(half).reshape(num_groups, width) @ scale).max()
+            for half in (high, low)
+        )
+        if bound < 2**62:
+            scale = np.left_shift(1, np.arange(width, dtype=np.int64))
+            group_high = high.reshape(num_groups, width) @ scale
+            group_low = low.reshape(num_groups, width) @ scale
+            sums[:] = (
+                (group_high.astype(object) << 26) + group_low.astype(object)
+            ) << base
+            return sums
+    if dense:
+        pairs = np.flatnonzero(high | low)
+        high, low = high[pairs], low[pairs]
+    else:
+        order = np.argsort(pairs, kind="stable")
+        pairs, high, low = pairs[order], high[order], low[order]
+
+    if not len(pairs):
+        return sums
+    pair_sums = ((high.astype(object) << 26) + low.astype(object)) << (
+        pairs % width
+    ).astype(object)
+    # Sorted by pair, the pairs of each group are contiguous
+    groups = pairs // width
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sums[groups[starts]] = np.add.reduceat(pair_sums, starts) << base
+    return sums
+
+
+def exact_sum_to_float(total):
+    """
+    Correctly rounded float64 value of an exact sum. The bits below the leading 64
+    are folded into a sticky bit, so the single rounding of float() is the correct
+    one and ldexp only rescales; this is much cheaper than a big-int division.
+    """
+    magnitude = abs(total)
+    if magnitude.bit_length() < EXACT_SUM_BITS - 1020:
+        # Subnormal results would be rounded twice; a true division rounds once
+        return total / 2**EXACT_SUM_BITS
+    extra = magnitude.bit_length() - 64
+    try:
+        if extra > 0:
+            sticky = 1 if magnitude & ((1 << extra) - 1) else 0
+            value = math.ldexp(
+                float((magnitude >> extra) | sticky), extra - EXACT_SUM_BITS
+            )
+        else:
+            value = math.ldexp(float(magnitude), -EXACT_SUM_BITS)
+    except OverflowError:
+        # Beyond the float64 range, like a float sum that overflows
+        value = math.inf
+    return -value if total < 0 else value
+
+
+def exact_sums_to_float(sums):
+    # Correctly rounded float64 values of exact group sums
+    import numpy as np
+
+    return np.array([exact_sum_to_float(total) for total in sums], dtype="float64")
+
+
+def group_totals(df, key, measure):
+    """
+    Exact sum and count of the non-null measure per key value, vectorized over
+    factorized keys. Returns (key values, sums, counts), ordered by key value; the
+    sums are exact (see exact_group_sums).
+    """
+    import numpy as np
+    import pandas as pd
+
+    codes, uniques = pd.factorize(df[key], sort=True)
+    values = df[measure].to_numpy(dtype="float64")
+    valid = (codes >= 0) & ~np.isnan(values)
+    sums = exact_group_sums(codes[valid], values[valid], len(uniques))
+    counts = np.bincount(codes[valid], minlength=len(uniques))
+    return np.asarray(uniques), sums, counts
+
+
+def validate_specs(specs):
+    # Fail before any data is read rather than after a long aggregation
+    for spec in specs:
+        if spec.agg not in AGGREGATIONS:
+            raise ValueError(
+                f"Unsupported agg {spec.agg!r} in spec {spec.name!r}; "
+                f"expected one of {AGGREGATIONS}"
+            )
+
+
+def finalize_aggregate(spec, key_values, sums, counts):
+    # Result frame of one spec, built from its group totals (sums already rounded
+    # from the exact sums)
+    import numpy as np
+    import pandas as pd
+
+    validate_specs([spec])
+    if spec.agg == "sum":
+        values = sums
+    elif spec.agg == "count":
+        values = counts
+    else:
+        values = np.divide(
+            sums, counts, out=np.full(len(sums), np.nan), where=counts > 0
+        )
+    result = pd.DataFrame({spec.key: key_values, spec.measure: values})
+    if spec.top_k:
+        # Partial selection instead of sorting every group
+        return result.nlargest(spec.top_k, spec.measure)
+    return result.sort_values(by=spec.measure, ascending=False)
+
 
-    # Sort by 'Rating' to display the results in descending order
-    country_avg_rate = country_avg_rate.sort_values(by="Rating", ascending=False)
+def new_partial_state(specs=ANALYSIS_SPECS):
+    # Per (key, measure): {key value: [exact sum, count]}
+    validate_specs(specs)
+    return {(spec.key, spec.measure): {} for spec in specs}
 
+
+def merge_group_totals(*totals):
+    """
+    Adds up several (key values, sums, counts) group totals of the same key and
+    measure. Returns the merged totals, ordered by first appearance of the key
+    value.
+    """
+    import numpy as np
+    import pandas as pd
+
+    codes, uniques = pd.factorize(
+        np.concatenate([key_values for key_values, _, _ in totals])
+    )
+    sums = np.full(len(uniques), 0, dtype=object)
+    np.add.at(sums, codes, np.concatenate([part for _, part, _ in totals]))
+    counts = np.bincount(
+        codes,
+        weights=np.concatenate([counts for _, _, counts in totals]),
+        minlength=len(uniques),
+    )
+    return np.asarray(uniques, dtype=object), sums, counts.astype("int64")
+
+
+def partial_state_from_totals(totals):
+    # Partial state of {(key, measure): (key values, sums, counts)} group totals
+    return {
+        group: {
+            name: [group_sum, group_count]
+            for name, group_sum, group_count in zip(
+                key_values.tolist(), sums.tolist(), counts.tolist()
+            )
+        }
+        for group, (key_values, sums, counts) in totals.items()
+    }
+
+
+def results_from_partial_state(state, specs=ANALYSIS_SPECS):
+    """
+    Turns the partial state into the same {spec name: result frame} as aggregate.
+    """
+    import numpy as np
+
+    rounded = {}
+    results = {}
+    for spec in specs:
+        if (spec.key, spec.measure) not in rounded:
+            totals = state[spec.key, spec.measure]
+            names = sorted(totals)
+            rounded[spec.key, spec.measure] = (
+                np.array(names, dtype=object),
+                exact_sums_to_float(totals[name][0] for name in names),
+                np.array([totals[name][1] for name in names], dtype="int64"),
+            )
+        results[spec.name] = finalize_aggregate(spec, *rounded[spec.key, spec.measure])
+    return results
+
+
+def aggregate(df, specs=ANALYSIS_SPECS):
+    """
+    Computes all specs with one pass per distinct (key, measure): specs that share
+    them reuse the same group totals, so adding KPIs adds no passes over the data.
+    Returns {spec name: result frame}.
+    """
+    validate_specs(specs)
+    totals = {}
+    results = {}
+    for spec in specs:
+        if (spec.key, spec.measure) not in totals:
+            key_values, sums, counts = group_totals(df, spec.key, spec.measure)
+            totals[spec.key, spec.measure] = (
+                key_values,
+                exact_sums_to_float(sums),
+                counts,
+            )
+        results[spec.name] = finalize_aggregate(spec, *totals[spec.key, spec.measure])
+    return results
+
+
+def aggregate_csv_chunks(source, specs=ANALYSIS_SPECS, chunk_rows=CHUNK_ROWS):
+    """
+    Folds a CSV file, path or stream, into the partial state of the specs without
+    loading it whole: only the needed columns are parsed, keys as categoricals.
+    Returns the state and the number of rows read.
+    """
+    import pandas as pd
+
+    dtype = {spec.measure: "float64" for spec in specs}
+    dtype.update({spec.key: "category" for spec in specs})
+    # Group totals of the chunks are merged vectorized, once the unmerged ones
+    # outgrow the merged totals; memory stays proportional to the number of groups
+    state = new_partial_state(specs)
+    parts = {group: [] for group in state}
+    rows = 0
+    for chunk in pd.read_csv(
+        source, usecols=analysis_columns(specs), dtype=dtype, chunksize=chunk_rows
+    ):
+        for (key, measure), group_parts in parts.items():
+            group_parts.append(group_totals(chunk, key, measure))
+            unmerged = sum(len(key_values) for key_values, _, _ in group_parts[1:])
+            if unmerged > len(group_parts[0][0]):
+                group_parts[:] = [merge_group_totals(*group_parts)]
+        rows += len(chunk)
+    if rows:
+        state.update(
+            partial_state_from_totals(
+                {group: merge_group_totals(*parts[group]) for group in parts}
+            )
+        )
+    return state, rows
+
+
+def analyze_csv_chunked(source, chunk_rows=CHUNK_ROWS):
+    """
+    Out-of-core version of analyze_df for CSV files larger than memory. The results
+    are identical to analyze_df on the same file, whatever the chunk size.
+    """
+    state, rows = aggregate_csv_chunks(source, ANALYSIS_SPECS, chunk_rows)
+    add_metrics(rows=rows)
+    print(f"Aggregated {rows} rows in chunks of {chunk_rows}")
+
+    results = results_from_partial_state(state)
+    country_avg_rate = results["country_avg_rate"]
+    top_3_categories = results["top_3_categories"]
+    print_analysis(country_avg_rate, top_3_categories)
+    return country_avg_rate, top_3_categories
+
+
+def aggregate_blob_stream(blob_client, chunk_rows=CHUNK_ROWS):
+    # Partial state and row count of a blob, parsed while it downloads
+    raw_stream = BlobChunkStream(blob_client.download_blob().chunks())
+    state, rows = aggregate_csv_chunks(
+        io.BufferedReader(raw_stream), ANALYSIS_SPECS, chunk_rows
+    )
+    add_metrics(bytes=raw_stream.bytes_read, rows=rows)
+    return state, rows
+
+
+def merge_partial_states(state, other):
+    # Add the sums and counts of another partial state into state
+    for group, totals in other.items():
+        merged = state.setdefault(group, {})
+        for name, (group_sum, group_count) in totals.items():
+            total = merged.setdefault(name, [0, 0])
+            total[0] += group_sum
+            total[1] += group_count
+    return state
+
+
+def aggregate_blob_worker(task):
+    """
+    Process pool worker: streams one blob and returns its partial state. Credentials
+    can't be pickled, so each worker process builds its own client with the task's
+    client factory, or uses its own shared client.
+    """
+    account_url, raw_container_name, blob_name, chunk_rows, client_factory = task
+    blob_service_client = (client_factory or get_blob_service_client)(account_url)
+    blob_client = blob_service_client.get_blob_client(raw_container_name, blob_name)
+    state, rows = aggregate_blob_stream(blob_client, chunk_rows)
+    return blob_name, state, rows
+
+
+def list_source_blobs(account_url, credential, raw_container_name, blob_prefix):
+    # Non-empty blobs under the prefix, largest first so the pool doesn't end on
+    # one big straggler
+    blob_service_client = get_blob_service_client(account_url, credential)
+    container_client = blob_service_client.get_container_client(raw_container_name)
+    return sorted(
+        (
+            blob
+            for blob in container_client.list_blobs(name_starts_with=blob_prefix)
+            if blob.size
+        ),
+        key=lambda blob: (-blob.size, blob.name),
+    )
+
+
+def aggregate_blobs_parallel(
+    account_url,
+    raw_container_name,
+    blob_names,
+    processes=None,
+    chunk_rows=CHUNK_ROWS,
+    client_factory=None,
+):
+    # Yields (blob name, partial state, rows) per blob, in the order of blob_names.
+    # The workers are spawned rather than forked: the `all` command runs this next
+    # to the provisioning and upload threads, and forking a multi-threaded process
+    # can deadlock the child. client_factory is therefore pickled to the workers,
+    # which don't see patched module globals
+    if not blob_names:
+        return
+    tasks = [
+        (account_url, raw_container_name, name, chunk_rows, client_factory)
+        for name in blob_names
+    ]
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for blob_name, state, rows in executor.map(aggregate_blob_worker, tasks):
+            print(f"Aggregated {rows} rows from blob {blob_name}")
+            yield blob_name, state, rows
+
+
+def analyze_blobs_parallel(
+    account_url,
+    credential,
+    raw_container_name,
+    blob_prefix,
+    processes=None,
+    chunk_rows=CHUNK_ROWS,
+    client_factory=None,
+):
+    """
+    Aggregates every blob under blob_prefix on a process pool. Each worker downloads
+    and partially aggregates its blobs; the partial states are merged into the same
+    country and category results as analyze_df. Workers build their
+    BlobServiceClient with client_factory(account_url) when it is given.
+    """
+    blobs = list_source_blobs(account_url, credential, raw_container_name, blob_prefix)
+
+    state = new_partial_state()
+    total_rows = 0
+    # Merged in listing order so the floating-point sums are reproducible
+    for _, blob_state, rows in aggregate_blobs_parallel(
+        account_url,
+        raw_container_name,
+        [blob.name for blob in blobs],
+        processes,
+        chunk_rows,
+        client_factory,
+    ):
+        merge_partial_states(state, blob_state)
+        total_rows += rows
+    # The workers' downloads are counted here, in the parent's stage
+    add_metrics(bytes=sum(blob.size for blob in blobs), rows=total_rows)
+    print(f"Aggregated {total_rows} rows from {len(blobs)} blobs under '{blob_prefix}'")
+
+    results = results_from_partial_state(state)
+    country_avg_rate = results["country_avg_rate"]
+    top_3_categories = results["top_3_categories"]
+    print_analysis(country_avg_rate, top_3_categories)
+    return country_avg_rate, top_3_categories
+
+
+def open_aggregate_store(store_path):
+    connection = sqlite3.connect(store_path)
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    if version != AGGREGATE_STORE_VERSION:
+        # Stores of older versions kept rounded sums; they are rebuilt from scratch
+        with connection:
+            connection.execute("DROP TABLE IF EXISTS partial_totals")
+            connection.execute("DROP TABLE IF EXISTS processed_blobs")
+    connection.executescript(AGGREGATE_STORE_SCHEMA)
+    connection.execute(f"PRAGMA user_version = {AGGREGATE_STORE_VERSION}")
+    return connection
+
+
+def store_blob_state(connection, blob_name, etag, state, rows):
+    # Replace the partial totals of one blob in a single transaction, so an
+    # interrupted run never leaves a blob half counted
+    with connection:
+        connection.execute("DELETE FROM partial_totals WHERE blob = ?", (blob_name,))
+        connection.executemany(
+            "INSERT INTO partial_totals VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (blob_name, key, measure, str(value), str(total), count)
+                for (key, measure), totals in state.items()
+                for value, (total, count) in totals.items()
+            ),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO processed_blobs VALUES (?, ?, ?)",
+            (blob_name, etag, rows),
+        )
+
+
+def forget_blob(connection, blob_name):
+    with connection:
+        connection.execute("DELETE FROM partial_totals WHERE blob = ?", (blob_name,))
+        connection.execute("DELETE FROM processed_blobs WHERE name = ?", (blob_name,))
+
+
+def load_partial_state(connection, blob_prefix="", specs=ANALYSIS_SPECS):
+    # Totals over the stored blobs under blob_prefix, in the partial state layout.
+    # Blobs of other prefixes sharing the store are kept but not counted
+    # The exact sums are too large for SQLite integers, so they are added up here
+    state = new_partial_state(specs)
+    for key, measure, value, total, count in connection.execute(
+        "SELECT key, measure, value, total, count FROM partial_totals "
+        "WHERE substr(blob, 1, length(?)) = ?",
+        (blob_prefix, blob_prefix),
+    ):
+        if (key, measure) in state:
+            totals = state[key, measure].setdefault(value, [0, 0])
+            totals[0] += int(total)
+            totals[1] += count
+    return state
+
+
+def analyze_blobs_incremental(
+    account_url,
+    credential,
+    raw_container_name,
+    blob_prefix,
+    store_path,
+    processes=None,
+    chunk_rows=CHUNK_ROWS,
+    client_factory=None,
+):
+    """
+    Like analyze_blobs_parallel, but keeps the partial totals of every blob in a
+    SQLite store. Only blobs that are new or whose ETag changed are downloaded and
+    aggregated, so a run costs in proportion to the new data.
+    """
+    blobs = list_source_blobs(account_url, credential, raw_container_name, blob_prefix)
+    etags = {blob.name: blob.etag for blob in blobs}
+
+    connection = open_aggregate_store(store_path)
+    try:
+        processed = dict(connection.execute("SELECT name, etag FROM processed_blobs"))
+        # Blobs deleted since the last run no longer count
+        removed = [
+            name
+            for name in processed
+            if name.startswith(blob_prefix) and name not in etags
+        ]
+        for name in removed:
+            forget_blob(connection, name)
+
+        changed = [blob.name for blob in blobs if processed.get(blob.name) != blob.etag]
+        new_rows = 0
+        for blob_name, state, rows in aggregate_blobs_parallel(
+            account_url,
+            raw_container_name,
+            changed,
+            processes,
+            chunk_rows,
+            client_factory,
+        ):
+            store_blob_state(connection, blob_name, etags[blob_name], state, rows)
+            new_rows += rows
+        add_metrics(
+            bytes=sum(blob.size for blob in blobs if blob.name in changed),
+            rows=new_rows,
+        )
+        print(
+            f"Folded {new_rows} rows from {len(changed)} new or changed blobs into "
+            f"{store_path} ({len(blobs) - len(changed)} unchanged, "
+            f"{len(removed)} removed)"
+        )
+        state = load_partial_state(connection, blob_prefix)
+    finally:
+        connection.close()
+
+    results = results_from_partial_state(state)
+    country_avg_rate = results["country_avg_rate"]
+    top_3_categories = results["top_3_categories"]
+    print_analysis(country_avg_rate, top_3_categories)
+    return country_avg_rate, top_3_categories
+
+
+def stream_analyze_from_azure(
+    account_url,
+    credential,
+    raw_container_name,
+    blob_name,
+    chunk_rows=CHUNK_ROWS,
+):
+    """
+    Aggregates the blob while it downloads, without writing it to disk or building
+    the full DataFrame. Memory stays bounded by one download chunk and chunk_rows.
+    """
+    blob_service_client = get_blob_service_client(account_url, credential)
+    blob_client = blob_service_client.get_blob_client(raw_container_name, blob_name)
+    state, rows = aggregate_blob_stream(blob_client, chunk_rows)
+    print(f"Streamed {rows} rows from blob {blob_name}")
+
+    results = results_from_partial_state(state)
+    country_avg_rate = results["country_avg_rate"]
+    top_3_categories = results["top_3_categories"]
+    print_analysis(country_avg_rate, top_3_categories)
+    return country_avg_rate, top_3_categories
+
+
+def fetch_source_data(
+    analysis_mode,
+    account_url,
+    credential,
+    raw_container_name,
+    blob_name,
+    local_file_path,
+    cache_dir=None,
+    cache_max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+    max_concurrency=1,
+    blob_prefix="",
+    processes=None,
+    store_path=None,
+):
+    """
+    Reads the source data for the given analysis mode: the loaded DataFrame
+    ("download"), the path of the local copy ("chunked"), or the already aggregated
+    results ("stream" for one blob, "blobs" for every blob under blob_prefix,
+    "incremental" for the blobs under blob_prefix folded into store_path).
+    """
+    if analysis_mode == "incremental":
+        return analyze_blobs_incremental(
+            account_url,
+            credential,
+            raw_container_name,
+            blob_prefix,
+            store_path,
+            processes,
+        )
+    if analysis_mode == "blobs":
+        return analyze_blobs_parallel(
+            account_url, credential, raw_container_name, blob_prefix, processes
+        )
+    if analysis_mode == "stream":
+        return stream_analyze_from_azure(
+            account_url, credential, raw_container_name, blob_name
+        )
+    read = (
+        download_data_from_azure if analysis_mode == "chunked" else read_data_from_azure
+    )
+    return read(
+        account_url,
+        credential,
+        raw_container_name,
+        blob_name,
+        local_file_path,
+        cache_dir,
+        cache_max_bytes,
+        max_concurrency,
+    )
+
+
+def print_analysis(country_avg_rate, top_3_categories):
     # Display the result
     print("Average Rating per Country:")
     print(country_avg_rate)
 
+    # Display the top 3 categories
+    print("\nTop 3 Categories by Average Rating:")
+    print(top_3_categories)
+
+
+def analyze_df(df):
+    # Both KPIs (see ANALYSIS_SPECS) are computed together from factorized keys
+    results = aggregate(df, ANALYSIS_SPECS)
+
+    # Average 'Rating' per 'Country', in descending order
+    country_avg_rate = results["country_avg_rate"]
+
     # Equivalent SQL Query:
     # SELECT Country, AVG(Rating) as average_rating
     # FROM tourism_dataset
     # GROUP BY Country
     # ORDER BY average_rating DESC;
 
-    # Group the data by 'Category' and calculate the average 'Rating'
-    category_avg_rate = df.groupby("Category")["Rating"].mean().reset_index()
-
-    # Sort the categories by average 'Rating' in descending order and select the top 3
-    top_3_categories = category_avg_rate.sort_values(by="Rating", ascending=False).head(
-        3
-    )
-
-    # Display the top 3 categories
-    print("\nTop 3 Categories by Average Rating:")
-    print(top_3_categories)
+    # Top 3 'Category' values by average 'Rating'
+    top_3_categories = results["top_3_categories"]
 
     # Equivalent SQL Query:
     # SELECT Category, AVG(Rating) as average_rating
@@ -206,35 +1279,121 @@ def analyze_df(df):
     # ORDER BY average_rating DESC
     # LIMIT 3;
 
+    print_analysis(country_avg_rate, top_3_categories)
+
     return country_avg_rate, top_3_categories
 
 
+def write_result_csv(f, country_avg_rate, top_3_categories):
+    # Step 1: Save the first DataFrame with its header
+    # Write country_avg_rate DataFrame with its own header
+    country_avg_rate.to_csv(f, index=False)
+
+    # Step 2: Write an empty line to separate the sections
+    f.write("\n")
+
+    # Step 3: Manually write the "Top 3 Categories" header
+    f.write("Top 3 Categories,Rating\n")
+
+    # Step 4: Write the top_3_categories DataFrame without a header (header written manually)
+    top_3_categories.to_csv(f, header=False, index=False)
+
+
 def save_result_to_csv(country_avg_rate, top_3_categories, result_file_name):
     # Saving the results to CSV file
-    # Step 1: Save the first DataFrame with its header
     with open(result_file_name, "w", newline="") as f:
-        # Write country_avg_rate DataFrame with its own header
-        country_avg_rate.to_csv(f, index=False)
+        write_result_csv(f, country_avg_rate, top_3_categories)
+    add_metrics(bytes=os.path.getsize(result_file_name))
 
-        # Step 2: Write an empty line to separate the sections
-        f.write("\n")
+    print(f"Concatenated DataFrame with separate headers saved as '{result_file_name}'")
 
-        # Step 3: Manually write the "Top 3 Categories" header
-        f.write("Top 3 Categories,Rating\n")
 
-        # Step 4: Write the top_3_categories DataFrame without a header (header written manually)
-        top_3_categories.to_csv(f, header=False, index=False)
+def result_parquet_frame(country_avg_rate, top_3_categories):
+    # Both results in one frame, the sections kept apart by a 'Section' column
+    import pandas as pd
+
+    result = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "Section": "Average Rating per Country",
+                    "Name": country_avg_rate["Country"],
+                    "Rating": country_avg_rate["Rating"],
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "Section": "Top 3 Categories",
+                    "Name": top_3_categories["Category"],
+                    "Rating": top_3_categories["Rating"],
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+    result["Section"] = result["Section"].astype("category")
+    return result
+
+
+def save_result_to_parquet(country_avg_rate, top_3_categories, result_file_name):
+    """
+    Saves both results to one Parquet file (requires pyarrow). The sections are kept
+    apart by a dictionary-encoded 'Section' column instead of separate CSV headers.
+    """
+    result_parquet_frame(country_avg_rate, top_3_categories).to_parquet(
+        result_file_name, index=False, compression="zstd", use_dictionary=True
+    )
+    add_metrics(bytes=os.path.getsize(result_file_name))
+    print(f"Results saved as '{result_file_name}'")
 
-    print(f"Concatenated DataFrame with separate headers saved as '{result_file_name}'")
+
+def serialize_result(country_avg_rate, top_3_categories, result_format="csv"):
+    # The bytes of the result file, built in memory instead of on disk
+    if result_format == "parquet":
+        buffer = io.BytesIO()
+        result_parquet_frame(country_avg_rate, top_3_categories).to_parquet(
+            buffer, index=False, compression="zstd", use_dictionary=True
+        )
+        return buffer.getvalue()
+    buffer = io.StringIO(newline="")
+    write_result_csv(buffer, country_avg_rate, top_3_categories)
+    return buffer.getvalue().encode()
+
+
+def upload_result(
+    container_client, directory_name, blob_name, data, gzip_encoding=False
+):
+    """
+    Uploads serialized results through an already open container client. With
+    gzip_encoding the body is compressed and stored with Content-Encoding: gzip.
+    """
+    from azure.storage.blob import ContentSettings
+
+    content_type = (
+        "application/vnd.apache.parquet"
+        if blob_name.endswith(".parquet")
+        else "text/csv"
+    )
+    if gzip_encoding:
+        data = gzip.compress(data)
+    content_settings = ContentSettings(
+        content_type=content_type,
+        content_encoding="gzip" if gzip_encoding else None,
+    )
+    blob_client = container_client.get_blob_client(f"{directory_name}/{blob_name}")
+    blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+    add_metrics(bytes=len(data))
+    print(
+        f"{blob_name} ({len(data)} bytes) uploaded to Azure Storage "
+        f"under {directory_name}/"
+    )
 
 
 def save_file_to_azure_storage(
     account_url, credential, directory_name, user_container_name, result_file_name
 ):
     # Define the directory in the Azure storage account
-    blob_service_client = BlobServiceClient(
-        account_url=account_url, credential=credential
-    )
+    blob_service_client = get_blob_service_client(account_url, credential)
 
     # Create a new container or directory (if needed, use a container client if required)
     container_client = blob_service_client.get_container_client(user_container_name)
@@ -245,6 +1404,7 @@ def save_file_to_azure_storage(
 
         with open(file_name, "rb") as data:
             blob_client.upload_blob(data, overwrite=True)
+        add_metrics(bytes=os.path.getsize(file_name))
         print(f"{blob_name} uploaded to Azure Storage under {directory_name}/")
 
     # Upload the CSV files
@@ -294,6 +1454,8 @@ def add_service_endpoint_and_configure_storage_networking(
             f"Microsoft.Storage service endpoint already configured on subnet {subnet.name}"
         )
 
+    from azure.mgmt.storage.models import VirtualNetworkRule
+
     # Create the new Virtual Network Rule
     new_vnet_rule = VirtualNetworkRule(
         virtual_network_resource_id=subnet.id, action="Allow"  # Subnet ID
@@ -336,7 +1498,47 @@ def add_service_endpoint_and_configure_storage_networking(
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deploy the VM and run the analysis.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="all",
+        choices=["all", *COMMAND_IMPORTS],
+        help="stage to run on its own; 'all' (default) runs every stage",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="only show which resources would be created or updated",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="call create_or_update on every resource, even unchanged ones",
+    )
+    args = parser.parse_args()
+    mode = "plan" if args.plan else "force" if args.force else "apply"
+    commands = list(COMMAND_IMPORTS) if args.command == "all" else [args.command]
+
     load_dotenv()
+    # Per-stage timings, bytes, rows and memory, written as JSON to RUN_REPORT;
+    # RUN_PROFILE=cprofile|tracemalloc additionally profiles every stage
+    run_report_path = os.getenv("RUN_REPORT")
+    report = start_run(
+        "Part2",
+        os.getenv("RUN_PROFILE") or None,
+        os.getenv("RUN_PROFILE_DIR", "profiles"),
+    )
+    for command in commands:
+        import_command_modules(command)
+    # An analyze on its own reads the blobs itself when streaming, so the storage
+    # modules are timed up front as well
+    if (
+        commands == ["analyze"]
+        and os.getenv("ANALYSIS_MODE", "download") in STREAMING_MODES
+    ):
+        import_command_modules("fetch")
+
     # Step 1: Deploy a Virtual Machine (VM)
     # Load environment variables
     subscription_id = os.getenv("SUBSCRIPTION_ID")
@@ -352,70 +1554,318 @@ if __name__ == "__main__":
     vm_password = os.getenv("VM_PASSWORD")
 
     ## 1: Initilize clients
-    credential, resource_client, network_client, compute_client, storage_client = (
-        initialize_clients(subscription_id, resource_group_name, location)
-    )
-
-    ## 2: Create a Virtual Network (VNet)
-    vnet = create_vnet(network_client, resource_group_name, vnet_name, location)
-
-    ## 3: Create a Network Security Group (NSG)
-    nsg = create_nsg(network_client, resource_group_name, nsg_name, location)
-
-    ## 4: Create a Subnet
-    subnet = create_subnet(
-        network_client, resource_group_name, vnet_name, subnet_name, nsg
-    )
-
-    ## 5: Create a Public IP
-    public_ip = create_public_ip(
-        network_client, resource_group_name, public_ip_name, location
-    )
-
-    ## 6: Create a Network Interface Card (NIC)
-    nic = create_nic(
-        network_client, resource_group_name, nic_name, public_ip, location, subnet
-    )
+    # Only provision and publish (which configures the storage networking) need the
+    # management clients. Otherwise the shared credential is only created when a
+    # blob client is built, so an analyze of a local file never loads azure.identity
+    manages_resources = "provision" in commands or "publish" in commands
+    if manages_resources:
+        with stage("initialize_clients"):
+            (
+                credential,
+                resource_client,
+                network_client,
+                compute_client,
+                storage_client,
+            ) = initialize_clients(
+                subscription_id,
+                resource_group_name,
+                location,
+                create_resource_group="provision" in commands and mode != "plan",
+            )
+    else:
+        credential = None
 
-    ## 7: Create a Virtual Machine (VM)
-    vm = create_vm(
-        compute_client,
-        resource_group_name,
-        vm_name,
-        location,
-        nic,
-        vm_username,
-        vm_password,
-    )
+    # Current state of every resource, fetched with parallel GETs, so unchanged
+    # resources are skipped instead of going through a long-running create_or_update
+    if not manages_resources or (mode == "force" and "provision" in commands):
+        state = {}
+    else:
+        with stage("fetch_deployed_state"):
+            state = fetch_deployed_state(
+                network_client,
+                compute_client,
+                resource_group_name,
+                vnet_name,
+                nsg_name,
+                subnet_name,
+                public_ip_name,
+                nic_name,
+                vm_name,
+            )
 
     # Step 2: Read Data from Azure Storage Account
     account_url = os.getenv("ACCOUNT_URL")
     raw_container_name = os.getenv("RAW_CONTAINER_NAME")
     blob_name = os.getenv("BLOB_NAME")
     local_file_path = os.getenv("LOCAL_FILE_PATH")
-
-    df = read_data_from_azure(
-        account_url, credential, raw_container_name, blob_name, local_file_path
+    # "download" saves the blob to LOCAL_FILE_PATH and loads it into a DataFrame,
+    # "chunked" saves it too but aggregates it chunk by chunk (for files larger
+    # than memory), "stream" aggregates the blob while it downloads, without a copy,
+    # "blobs" aggregates every blob under BLOB_PREFIX on ANALYSIS_PROCESSES processes,
+    # "incremental" does the same for new or changed blobs only, kept in AGGREGATE_STORE
+    analysis_mode = os.getenv("ANALYSIS_MODE", "download")
+    blob_prefix = os.getenv("BLOB_PREFIX", "")
+    analysis_processes = int(os.getenv("ANALYSIS_PROCESSES", os.cpu_count()))
+    aggregate_store = os.getenv("AGGREGATE_STORE", "aggregates.sqlite")
+    # Cache of downloaded source blobs, revalidated by ETag (disabled when empty)
+    download_cache_dir = os.getenv("DOWNLOAD_CACHE_DIR")
+    download_cache_max_mb = int(
+        os.getenv("DOWNLOAD_CACHE_MAX_MB", DOWNLOAD_CACHE_MAX_MB)
     )
-    print(df.head())
-
-    # Step 3: Perform Data Analysis
-    country_avg_rate, top_3_categories = analyze_df(df)
+    download_concurrency = int(os.getenv("DOWNLOAD_CONCURRENCY", DOWNLOAD_CONCURRENCY))
 
-    # Step 4: Export Results and Save to Azure Storage, Configure Networking
+    # Sub-steps 2-7 and the blob download run as a DAG: the VNet, NSG, public IP and
+    # download start together, and each step only waits on what it depends on
+    steps = {}
+    if "provision" in commands:
+        steps.update(
+            {
+                ## 2: Create a Virtual Network (VNet)
+                "vnet": (
+                    lambda: create_vnet(
+                        network_client,
+                        resource_group_name,
+                        vnet_name,
+                        location,
+                        state.get("vnet"),
+                        mode,
+                    ),
+                    [],
+                ),
+                ## 3: Create a Network Security Group (NSG)
+                "nsg": (
+                    lambda: create_nsg(
+                        network_client,
+                        resource_group_name,
+                        nsg_name,
+                        location,
+                        state.get("nsg"),
+                        mode,
+                    ),
+                    [],
+                ),
+                ## 4: Create a Subnet
+                "subnet": (
+                    lambda vnet, nsg: create_subnet(
+                        network_client,
+                        resource_group_name,
+                        vnet_name,
+                        subnet_name,
+                        nsg,
+                        state.get("subnet"),
+                        mode,
+                    ),
+                    ["vnet", "nsg"],
+                ),
+                ## 5: Create a Public IP
+                "public_ip": (
+                    lambda: create_public_ip(
+                        network_client,
+                        resource_group_name,
+                        public_ip_name,
+                        location,
+                        state.get("public_ip"),
+                        mode,
+                    ),
+                    [],
+                ),
+                ## 6: Create a Network Interface Card (NIC)
+                "nic": (
+                    lambda public_ip, subnet: create_nic(
+                        network_client,
+                        resource_group_name,
+                        nic_name,
+                        public_ip,
+                        location,
+                        subnet,
+                        state.get("nic"),
+                        mode,
+                    ),
+                    ["public_ip", "subnet"],
+                ),
+                ## 7: Create a Virtual Machine (VM)
+                "vm": (
+                    lambda nic: create_vm(
+                        compute_client,
+                        resource_group_name,
+                        vm_name,
+                        location,
+                        nic,
+                        vm_username,
+                        vm_password,
+                        state.get("vm"),
+                        mode,
+                    ),
+                    ["nic"],
+                ),
+            }
+        )
+    if args.command == "all":
+        # The source is read alongside provisioning
+        steps["read_data"] = (
+            lambda: fetch_source_data(
+                analysis_mode,
+                account_url,
+                credential,
+                raw_container_name,
+                blob_name,
+                local_file_path,
+                download_cache_dir,
+                download_cache_max_mb * 1024 * 1024,
+                download_concurrency,
+                blob_prefix,
+                analysis_processes,
+                aggregate_store,
+            ),
+            [],
+        )
+    elif args.command == "fetch":
+        if analysis_mode in STREAMING_MODES:
+            print(
+                f"ANALYSIS_MODE={analysis_mode} reads the source in the analyze command"
+            )
+        else:
+            # Leaves the local copy (or cached copy) for the analyze command
+            steps["read_data"] = (
+                lambda: download_data_from_azure(
+                    account_url,
+                    credential,
+                    raw_container_name,
+                    blob_name,
+                    local_file_path,
+                    download_cache_dir,
+                    download_cache_max_mb * 1024 * 1024,
+                    download_concurrency,
+                ),
+                [],
+            )
+    if mode == "plan":
+        # Nothing is downloaded or changed when only planning
+        steps.pop("read_data", None)
+        run_dag(steps)
+        raise SystemExit(0)
+
+    results = {}
+    if steps:
+        results, timings = run_dag(steps)
+        print_timings(timings)
+
+    # Step 4 settings, also used by analyze to save the result file
     user_container_name = os.getenv("USER_CONTAINER_NAME")
     result_file_name = os.getenv("RESULT_FILE_NAME")
     directory_name = os.getenv("DIRECTORY_NAME")
     storage_account_name = os.getenv("STORAGE_ACCOUNT_NAME")
-    save_result_to_csv(country_avg_rate, top_3_categories, result_file_name)
-    save_file_to_azure_storage(
-        account_url, credential, directory_name, user_container_name, result_file_name
-    )
-    add_service_endpoint_and_configure_storage_networking(
-        storage_client,
-        network_client,
-        resource_group_name,
-        storage_account_name,
-        vnet,
-        subnet,
-    )
+    # "csv" (default) or "parquet"
+    result_format = os.getenv("RESULT_FORMAT", "csv")
+    if result_format == "parquet":
+        result_file_name = os.path.splitext(result_file_name)[0] + ".parquet"
+    # "file" (default) saves the results locally before uploading them, "memory"
+    # uploads them straight from a buffer, gzip-encoded when RESULT_GZIP is true
+    result_upload = os.getenv("RESULT_UPLOAD", "file")
+    result_gzip = os.getenv("RESULT_GZIP", "false").lower() == "true"
+
+    # Step 3: Perform Data Analysis
+    if "analyze" in commands:
+        if "read_data" in results:
+            source = results["read_data"]
+        elif analysis_mode in STREAMING_MODES:
+            with stage("read_data"):
+                source = fetch_source_data(
+                    analysis_mode,
+                    account_url,
+                    credential,
+                    raw_container_name,
+                    blob_name,
+                    local_file_path,
+                    blob_prefix=blob_prefix,
+                    processes=analysis_processes,
+                    store_path=aggregate_store,
+                )
+        else:
+            # The copy left by the fetch command, read as is without contacting Azure
+            with stage("read_data"):
+                source = local_file_path
+                if download_cache_dir:
+                    source = cached_blob_path(
+                        download_cache_dir, account_url, raw_container_name, blob_name
+                    )
+                    if not os.path.exists(source):
+                        raise FileNotFoundError(
+                            f"No cached copy of {blob_name} in {download_cache_dir}, "
+                            "run the fetch command first"
+                        )
+                if analysis_mode == "download":
+                    source = load_data(source)
+
+        if analysis_mode in STREAMING_MODES:
+            # Already aggregated while the blobs were streamed
+            country_avg_rate, top_3_categories = source
+        elif analysis_mode == "chunked":
+            with stage("analyze_csv_chunked"):
+                country_avg_rate, top_3_categories = analyze_csv_chunked(source)
+        else:
+            df = source
+            print(df.head())
+            with stage("analyze_df") as metrics:
+                metrics["rows"] = len(df)
+                country_avg_rate, top_3_categories = analyze_df(df)
+
+        # The publish command uploads the saved file, unless it is run in the
+        # same process and uploads the results straight from memory
+        if args.command != "all" or result_upload != "memory":
+            with stage("save_result"):
+                if result_format == "parquet":
+                    save_result_to_parquet(
+                        country_avg_rate, top_3_categories, result_file_name
+                    )
+                else:
+                    save_result_to_csv(
+                        country_avg_rate, top_3_categories, result_file_name
+                    )
+
+    # Step 4: Export Results and Save to Azure Storage, Configure Networking
+    if "publish" in commands:
+        if args.command == "all" and result_upload == "memory":
+            container_client = get_blob_service_client(
+                account_url, credential
+            ).get_container_client(user_container_name)
+            with stage("serialize_result"):
+                data = serialize_result(
+                    country_avg_rate, top_3_categories, result_format
+                )
+            with stage("upload"):
+                upload_result(
+                    container_client,
+                    directory_name,
+                    result_file_name,
+                    data,
+                    result_gzip,
+                )
+        else:
+            with stage("upload"):
+                save_file_to_azure_storage(
+                    account_url,
+                    credential,
+                    directory_name,
+                    user_container_name,
+                    result_file_name,
+                )
+        # The VNet and subnet just provisioned, or the deployed ones
+        vnet = results.get("vnet") or state.get("vnet")
+        subnet = results.get("subnet") or state.get("subnet")
+        if subnet is None:
+            print(f"Subnet {subnet_name} not found, run the provision command first.")
+        else:
+            with stage("storage_networking"):
+                add_service_endpoint_and_configure_storage_networking(
+                    storage_client,
+                    network_client,
+                    resource_group_name,
+                    storage_account_name,
+                    vnet,
+                    subnet,
+                )
+
+    report.print_summary()
+    if run_report_path:
+        report.write(run_report_path)
@@ -0,0 +1,122 @@
+"""
+Shared Azure credential and client factory used by the Part1 and Part2 scripts.
+
+Every client built here shares one credential, whose access tokens are cached until
+shortly before they expire, and one HTTP session with a pooled, keep-alive
+connection adapter. Repeated operations therefore skip the credential chain, token
+requests and TLS handshakes. Clients are cached per process, so forked worker
+processes never reuse sockets opened by their parent.
+"""
+
+import functools
+import os
+import threading
+import time
+
+# The SDKs are imported on first use, so importing this module stays cheap for
+# scripts and commands that never talk to Azure
+
+# Connections kept open per host; should cover the concurrent requests of a run
+HTTP_POOL_SIZE = 32
+# Seconds before expiry at which a cached token is refreshed
+TOKEN_REFRESH_MARGIN = 300
+
+
+class CachedTokenCredential:
+    """
+    Wraps a credential and reuses its tokens per scope until they are about to
+    expire. Credentials such as the Azure CLI one otherwise fetch a token for every
+    client that asks.
+    """
+
+    def __init__(self, credential):
+        self._credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, claims=None, tenant_id=None, **kwargs):
+        if claims or tenant_id:
+            # Challenges and other tenants always go to the wrapped credential
+            return self._credential.get_token(
+                *scopes, claims=claims, tenant_id=tenant_id, **kwargs
+            )
+        key = (scopes, tuple(sorted(kwargs.items())))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - TOKEN_REFRESH_MARGIN < time.time():
+                token = self._credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    def close(self):
+        self._credential.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _credential(pid):
+    from azure.identity import DefaultAzureCredential
+
+    return CachedTokenCredential(DefaultAzureCredential())
+
+
+@functools.lru_cache(maxsize=None)
+def _transport(pid):
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+
+    # Read on first use, so a value loaded from the .env file applies
+    pool_size = int(os.getenv("AZURE_HTTP_POOL_SIZE", HTTP_POOL_SIZE))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # The session outlives the clients, so closing one client keeps the pool open
+    return RequestsTransport(session=session, session_owner=False)
+
+
+@functools.lru_cache(maxsize=None)
+def _blob_service_client(pid, account_url, credential, connection_string):
+    from azure.storage.blob import BlobServiceClient
+
+    if connection_string:
+        return BlobServiceClient.from_connection_string(
+            connection_string, transport=_transport(pid)
+        )
+    return BlobServiceClient(
+        account_url=account_url,
+        credential=credential or _credential(pid),
+        transport=_transport(pid),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _mgmt_client(pid, client_class, subscription_id):
+    return client_class(_credential(pid), subscription_id, transport=_transport(pid))
+
+
+def get_credential():
+    # The shared credential of this process
+    return _credential(os.getpid())
+
+
+def get_transport():
+    # The shared pooled HTTP transport of this process
+    return _transport(os.getpid())
+
+
+def get_blob_service_client(account_url=None, credential=None, connection_string=None):
+    """
+    Returns the cached BlobServiceClient for an account URL (with the shared
+    credential unless one is given) or for a connection string.
+    """
+    return _blob_service_client(os.getpid(), account_url, credential, connection_string)
+
+
+def get_mgmt_client(client_class, subscription_id):
+    """
+    Returns the cached management client of the given class, e.g.
+    get_mgmt_client(NetworkManagementClient, subscription_id).
+    """
+    return _mgmt_client(os.getpid(), client_class, subscription_id)
@@ -0,0 +1,85 @@
+"""
+Helpers shared by Part1/Part1Q1_benchmark.py and pipeline_benchmark.py.
+
+Every case runs in a fresh child process, so the peak memory it reports is that of
+the case alone. The child sends back its measurements, or the traceback of its
+failure, on a queue; a child that dies without reporting fails the run instead of
+hanging it.
+"""
+
+import math
+import multiprocessing as mp
+import statistics
+import traceback
+from queue import Empty
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a list of timings
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+def summarize_timings(timings):
+    return {
+        "repeats": len(timings),
+        "median": statistics.median(timings),
+        "p95": percentile(timings, 95),
+        "min": min(timings),
+        "mean": statistics.fmean(timings),
+    }
+
+
+def parse_int_list(value):
+    # Comma-separated counts, e.g. 1e5,1e6
+    return [int(float(item)) for item in value.split(",") if item]
+
+
+def _report(queue, target, args):
+    try:
+        queue.put(("ok", target(*args)))
+    except Exception:
+        queue.put(("error", traceback.format_exc()))
+
+
+def _wait_for_report(process, queue, poll_interval):
+    while process.is_alive():
+        try:
+            return queue.get(timeout=poll_interval)
+        except Empty:
+            pass
+    # The child may have reported just before exiting
+    try:
+        return queue.get(timeout=poll_interval)
+    except Empty:
+        return "exited", process.exitcode
+
+
+def run_isolated(target, args, description, poll_interval=1.0):
+    """
+    Runs target(*args) in a fresh child process and returns its result. Raises
+    RuntimeError with the child's traceback when it fails, or when it exits without
+    reporting (killed, out of memory).
+    """
+    queue = mp.Queue()
+    process = mp.Process(target=_report, args=(queue, target, args))
+    process.start()
+    try:
+        status, value = _wait_for_report(process, queue, poll_interval)
+    finally:
+        process.join()
+    if status == "error":
+        raise RuntimeError(f"{description} failed:\n{value}")
+    if status == "exited":
+        raise RuntimeError(f"{description} exited with code {value} without a result")
+    return value
+
+
+def find_regressions(results, previous, key, threshold):
+    # Pairs of (result, previous result) whose median got slower than the threshold
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old and result["median"] > old["median"] * (1 + threshold):
+            regressions.append((result, old))
+    return regressions
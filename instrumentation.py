@@ -0,0 +1,198 @@
+"""
+Lightweight instrumentation for the Part1 and Part2 scripts.
+
+A run report collects one record per pipeline stage: wall and CPU time, bytes
+transferred, rows processed and the resident memory of the process, and is written
+out as JSON. Optionally every stage is profiled with cProfile (one .prof file per
+stage) or the run is traced with tracemalloc (per-stage peak of Python allocations
+and the top allocation sites of the run).
+"""
+
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is left out there
+    resource = None
+
+# Profilers accepted by start_run
+PROFILERS = ("cprofile", "tracemalloc")
+
+# Number of allocation sites listed in the report with tracemalloc
+TRACEMALLOC_TOP = 10
+
+_active_report = None
+_local = threading.local()
+
+
+def current_rss_mb():
+    # Resident set size right now, from /proc where available
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def peak_rss_mb(children=False):
+    # Highest resident set size of the process so far (kilobytes on Linux, bytes on
+    # macOS), or of its largest terminated child process
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+class RunReport:
+    """
+    Records the stages of one run. Stages may run concurrently on different
+    threads; with tracemalloc the peaks of overlapping stages include each other.
+    """
+
+    def __init__(self, name, profile=None, profile_dir="profiles"):
+        if profile not in (None, *PROFILERS):
+            raise ValueError(f"profile must be one of {PROFILERS}, got {profile!r}")
+        self.name = name
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.started_at = datetime.now(timezone.utc)
+        self.stages = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        if profile == "cprofile":
+            os.makedirs(profile_dir, exist_ok=True)
+        elif profile == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as one stage. Yields the stage's metrics dict;
+        bytes and rows can be set on it directly or through add_metrics.
+        """
+        metrics = {"name": name, "thread": threading.current_thread().name}
+        stack = _local.__dict__.setdefault("stages", [])
+        stack.append(metrics)
+
+        profiler = None
+        if self.profile == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler can be active at a time on newer Pythons, so a
+                # stage overlapping a profiled one is not profiled
+                profiler = None
+        elif self.profile == "tracemalloc":
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield metrics
+        except BaseException as error:
+            metrics["error"] = repr(error)
+            raise
+        finally:
+            metrics["start"] = start - self._start
+            metrics["wall"] = time.perf_counter() - start
+            metrics["cpu"] = time.thread_time() - cpu_start
+            metrics["rss_mb"] = current_rss_mb()
+            metrics["peak_rss_mb"] = peak_rss_mb()
+            if profiler is not None:
+                profiler.disable()
+                metrics["profile"] = os.path.join(self.profile_dir, f"{name}.prof")
+                profiler.dump_stats(metrics["profile"])
+            elif self.profile == "tracemalloc":
+                _, peak = tracemalloc.get_traced_memory()
+                metrics["tracemalloc_peak_mb"] = peak / (1024 * 1024)
+            stack.pop()
+            with self._lock:
+                self.stages.append(metrics)
+
+    def to_dict(self):
+        report = {
+            "run": self.name,
+            "started_at": self.started_at.isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pid": os.getpid(),
+            "wall": time.perf_counter() - self._start,
+            "peak_rss_mb": peak_rss_mb(),
+            "profile": self.profile,
+            "stages": sorted(self.stages, key=lambda stage: stage["start"]),
+        }
+        if self.profile == "tracemalloc" and tracemalloc.is_tracing():
+            statistics = tracemalloc.take_snapshot().statistics("lineno")
+            report["tracemalloc_top"] = [
+                {"site": str(stat.traceback), "size_mb": stat.size / (1024 * 1024)}
+                for stat in statistics[:TRACEMALLOC_TOP]
+            ]
+        return report
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f"Run report saved to {path}")
+
+    def print_summary(self):
+        print(f"\nRun report '{self.name}':")
+        for stage in sorted(self.stages, key=lambda stage: stage["start"]):
+            counts = "".join(
+                f"  {key} {stage[key]}" for key in ("rows", "bytes") if key in stage
+            )
+            print(
+                f"  {stage['name']:<20} wall {stage['wall']:7.2f}s  "
+                f"cpu {stage['cpu']:7.2f}s{counts}"
+            )
+
+
+def start_run(name, profile=None, profile_dir="profiles"):
+    """
+    Starts the run report that stage() records into, and returns it.
+    """
+    global _active_report
+    _active_report = RunReport(name, profile, profile_dir)
+    return _active_report
+
+
+def get_report():
+    # The report started by start_run, or None
+    return _active_report
+
+
+@contextmanager
+def stage(name):
+    """
+    Records the enclosed block as a stage of the active run report. Without an
+    active report it only yields a metrics dict that is then discarded.
+    """
+    if _active_report is None:
+        yield {"name": name}
+        return
+    with _active_report.stage(name) as metrics:
+        yield metrics
+
+
+def add_metrics(**counts):
+    """
+    Adds counts such as bytes=... or rows=... to the innermost stage running on
+    this thread, if any.
+    """
+    stack = getattr(_local, "stages", None)
+    if not stack:
+        return
+    metrics = stack[-1]
+    for key, value in counts.items():
+        metrics[key] = metrics.get(key, 0) + value
@@ -0,0 +1,651 @@
+"""
+Offline end-to-end benchmarks of the Part1 and Part2 pipelines.
+
+Synthetic tourism datasets are served from a local blob store with the
+download_blob/upload_blob/list_blobs surface of the Azure SDK. Activity logs come
+from the RecordedActivityLogs pager of Part1Q4. Every case runs in its own process
+and reports throughput and peak memory. Results are appended to a JSON Lines
+history, so each run can be compared with the previous runs of the same case:
+
+    python pipeline_benchmark.py --sizes 1e5,1e6 --label my-change --check
+"""
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+from benchmarking import (
+    find_regressions,
+    parse_int_list,
+    run_isolated,
+    summarize_timings,
+)
+from instrumentation import peak_rss_mb, stage, start_run
+
+# The pipeline scripts live in their own folders
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT_DIR, "Part1"))
+sys.path.append(os.path.join(ROOT_DIR, "Part2"))
+
+# Values of the synthetic tourism dataset, in the shape of tourism_dataset.csv
+COUNTRIES = ["Australia", "Brazil", "China", "Egypt", "France", "India", "USA"]
+CATEGORIES = ["Adventure", "Beach", "Cultural", "Historical", "Nature", "Urban"]
+DATASET_HEADER = (
+    "Location,Country,Category,Visitors,Rating,Revenue,Accommodation_Available\n"
+)
+GENERATE_CHUNK_ROWS = 1_000_000
+
+# Cases of each suite; the publish cases upload the small result file, so they
+# don't depend on the dataset size and run once
+SUITES = {
+    "part2": ["download", "chunked", "stream", "blobs", "incremental"],
+    "publish": ["file", "memory", "gzip"],
+    "part1q3": ["single", "blocks", "sync"],
+    "part1q4": ["sequential", "parallel", "parquet"],
+}
+
+ACCOUNT_URL = "https://benchmark.blob.core.windows.net"
+RAW_CONTAINER = "raw"
+USER_CONTAINER = "user"
+BLOB_PARTS = 8
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class LocalBlob:
+    """
+    Blob client backed by a file under the store root, with the parts of the
+    BlobClient API that the pipeline uses.
+    """
+
+    def __init__(self, root, container_name, blob_name):
+        self.account_name = "benchmark"
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.path = os.path.join(root, container_name, blob_name)
+        self.staging_dir = os.path.join(root, ".staging", container_name, blob_name)
+
+    def properties(self):
+        stat = os.stat(self.path)
+        meta_path = f"{self.path}.meta"
+        content_md5 = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                md5 = json.load(f).get("content_md5")
+            content_md5 = bytearray.fromhex(md5) if md5 else None
+        return SimpleNamespace(
+            name=self.blob_name,
+            size=stat.st_size,
+            etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            content_settings=SimpleNamespace(content_md5=content_md5),
+        )
+
+    def download_blob(self, max_concurrency=1, etag=None, match_condition=None):
+        if not os.path.exists(self.path):
+            raise ResourceNotFoundError(f"Blob {self.blob_name} not found")
+        properties = self.properties()
+        if match_condition == MatchConditions.IfModified and etag == properties.etag:
+            # Like the storage SDK, which reports 304 as a plain HttpResponseError
+            error = HttpResponseError("The condition specified was not met")
+            error.status_code, error.reason = 304, "Not Modified"
+            raise error
+        return LocalDownloader(self.path, properties)
+
+    def upload_blob(self, data, overwrite=False, content_settings=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, DOWNLOAD_CHUNK_SIZE)
+        self.write_meta(content_settings)
+
+    def stage_block(self, block_id, data, length=None):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        with open(os.path.join(self.staging_dir, block_id), "wb") as f:
+            f.write(data)
+
+    def get_block_list(self, block_list_type="committed"):
+        if not os.path.isdir(self.staging_dir):
+            raise ResourceNotFoundError(f"Blob {self.blob_name} not found")
+        return [], [
+            SimpleNamespace(id=entry.name, size=entry.stat().st_size)
+            for entry in os.scandir(self.staging_dir)
+        ]
+
+    def commit_block_list(self, blocks, content_settings=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            for block in blocks:
+                with open(os.path.join(self.staging_dir, block.id), "rb") as part:
+                    shutil.copyfileobj(part, f, DOWNLOAD_CHUNK_SIZE)
+        shutil.rmtree(self.staging_dir)
+        self.write_meta(content_settings)
+
+    def write_meta(self, content_settings):
+        md5 = getattr(content_settings, "content_md5", None)
+        with open(f"{self.path}.meta", "w") as f:
+            json.dump({"content_md5": bytes(md5).hex() if md5 else None}, f)
+
+
+class LocalDownloader:
+    # The StorageStreamDownloader surface: size, properties, readinto and chunks
+
+    def __init__(self, path, properties):
+        self.path = path
+        self.properties = properties
+        self.size = properties.size
+
+    def readinto(self, stream):
+        with open(self.path, "rb") as f:
+            shutil.copyfileobj(f, stream, DOWNLOAD_CHUNK_SIZE)
+        return self.size
+
+    def chunks(self):
+        with open(self.path, "rb") as f:
+            yield from iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b"")
+
+
+class LocalContainer:
+    def __init__(self, root, container_name):
+        self.root = root
+        self.container_name = container_name
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.root, self.container_name))
+
+    def create_container(self):
+        os.makedirs(os.path.join(self.root, self.container_name), exist_ok=True)
+
+    def get_blob_client(self, blob_name):
+        return LocalBlob(self.root, self.container_name, blob_name)
+
+    def list_blobs(self, name_starts_with=None):
+        container_dir = os.path.join(self.root, self.container_name)
+        for directory, _, file_names in os.walk(container_dir):
+            for file_name in sorted(file_names):
+                if file_name.endswith(".meta"):
+                    continue
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, container_dir).replace(os.sep, "/")
+                if name.startswith(name_starts_with or ""):
+                    yield self.get_blob_client(name).properties()
+
+
+class LocalBlobServiceClient:
+    """
+    Offline stand-in for BlobServiceClient; containers are directories under root.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_container_client(self, container_name):
+        return LocalContainer(self.root, container_name)
+
+    def get_blob_client(self, container_name, blob_name):
+        return LocalBlob(self.root, container_name, blob_name)
+
+
+def local_blob_service_client(root, account_url=None):
+    # Client factory handed to the Part2 worker processes; unlike a patched module
+    # global, it also reaches workers started with spawn or forkserver
+    return LocalBlobServiceClient(root)
+
+
+def generate_chunk(rng, rows):
+    # One chunk of the synthetic dataset as CSV text, without a header
+    letters = rng.integers(ord("a"), ord("z") + 1, size=(rows, 10), dtype=np.uint8)
+    columns = [
+        letters.view("S10").ravel().astype(str),
+        np.array(COUNTRIES)[rng.integers(0, len(COUNTRIES), rows)],
+        np.array(CATEGORIES)[rng.integers(0, len(CATEGORIES), rows)],
+        rng.integers(1_000, 1_000_000, rows).astype(str),
+        np.char.mod("%.2f", rng.uniform(1.0, 5.0, rows)),
+        np.char.mod("%.2f", rng.uniform(1_000, 1_000_000, rows)),
+        np.array(["Yes", "No"])[rng.integers(0, 2, rows)],
+    ]
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = np.char.add(np.char.add(lines, ","), column)
+    return "\n".join(lines) + "\n"
+
+
+def generate_dataset(data_dir, size, parts=BLOB_PARTS, seed=0):
+    """
+    Writes a dataset of size rows once, both as one blob (tourism_dataset.csv) and
+    split into parts (parts/part-NNNN.csv), in a local store under data_dir. Chunks
+    are generated one at a time, so 1e8 rows need no more memory than 1e6.
+    """
+    store_dir = os.path.join(data_dir, f"tourism-{size}-{seed}")
+    raw_dir = os.path.join(store_dir, RAW_CONTAINER)
+    done_path = os.path.join(store_dir, "complete")
+    if os.path.exists(done_path):
+        return store_dir
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.makedirs(os.path.join(raw_dir, "parts"))
+    rng = np.random.default_rng(seed)
+    rows_per_part = -(-size // parts)
+    start_time = time.perf_counter()
+    with open(os.path.join(raw_dir, "tourism_dataset.csv"), "w") as full:
+        full.write(DATASET_HEADER)
+        for part in range(parts):
+            part_rows = min(rows_per_part, size - part * rows_per_part)
+            part_path = os.path.join(raw_dir, "parts", f"part-{part:04d}.csv")
+            with open(part_path, "w") as part_file:
+                part_file.write(DATASET_HEADER)
+                for offset in range(0, part_rows, GENERATE_CHUNK_ROWS):
+                    text = generate_chunk(
+                        rng, min(GENERATE_CHUNK_ROWS, part_rows - offset)
+                    )
+                    full.write(text)
+                    part_file.write(text)
+    open(done_path, "w").close()
+    print(
+        f"Generated {size} rows in {store_dir} "
+        f"in {time.perf_counter() - start_time:.1f} seconds"
+    )
+    return store_dir
+
+
+@functools.lru_cache(maxsize=None)
+def synthetic_activity_logs(count, end_time, seed=0):
+    # count events spread over the day before end_time, built once per process
+    from azure.mgmt.monitor.models import EventData
+
+    rng = np.random.default_rng(seed)
+    offsets = rng.uniform(0, 24 * 3600, count)
+    return [
+        EventData.from_dict(
+            {
+                "correlation_id": f"correlation-{index}",
+                "event_data_id": f"event-{index}",
+                "event_timestamp": (end_time - timedelta(seconds=offset)).isoformat(),
+                "operation_name": {"value": "write", "localized_value": "Write"},
+                "status": {"value": "Succeeded", "localized_value": "Succeeded"},
+                "category": {"value": "Administrative"},
+                "level": "Informational",
+                "caller": "benchmark@example.com",
+                "resource_type": {"value": "Microsoft.Compute/virtualMachines"},
+                "resource_group_name": "benchmark-rg",
+                "resource_id": "/subscriptions/benchmark/vm",
+                "subscription_id": "benchmark",
+            }
+        )
+        for index, offset in enumerate(offsets)
+    ]
+
+
+def prepare_part2_case(mode, store_dir, work_dir, processes):
+    # Returns the timed function of a Part2 case; setup work is done here
+    import Part2
+
+    service = LocalBlobServiceClient(store_dir)
+    Part2.get_blob_service_client = lambda *args, **kwargs: service
+    client_factory = functools.partial(local_blob_service_client, store_dir)
+    local_path = os.path.join(work_dir, "tourism_dataset.csv")
+    store_path = os.path.join(work_dir, "aggregates.sqlite")
+
+    if mode == "download":
+        return lambda: Part2.analyze_df(
+            Part2.read_data_from_azure(
+                ACCOUNT_URL, None, RAW_CONTAINER, "tourism_dataset.csv", local_path
+            )
+        )
+    if mode == "chunked":
+        return lambda: Part2.analyze_csv_chunked(
+            Part2.download_data_from_azure(
+                ACCOUNT_URL, None, RAW_CONTAINER, "tourism_dataset.csv", local_path
+            )
+        )
+    if mode == "stream":
+        return lambda: Part2.stream_analyze_from_azure(
+            ACCOUNT_URL, None, RAW_CONTAINER, "tourism_dataset.csv"
+        )
+    if mode == "blobs":
+        return lambda: Part2.analyze_blobs_parallel(
+            ACCOUNT_URL,
+            None,
+            RAW_CONTAINER,
+            "parts/",
+            processes,
+            client_factory=client_factory,
+        )
+    if mode == "incremental":
+        # The store already holds every part; one part then changes, as if a new
+        # file had landed, and only that part is folded in
+        if os.path.exists(store_path):
+            os.remove(store_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            Part2.analyze_blobs_incremental(
+                ACCOUNT_URL,
+                None,
+                RAW_CONTAINER,
+                "parts/",
+                store_path,
+                processes,
+                client_factory=client_factory,
+            )
+        part_path = os.path.join(store_dir, RAW_CONTAINER, "parts", "part-0000.csv")
+        os.utime(part_path, ns=(time.time_ns(), time.time_ns()))
+        return lambda: Part2.analyze_blobs_incremental(
+            ACCOUNT_URL,
+            None,
+            RAW_CONTAINER,
+            "parts/",
+            store_path,
+            processes,
+            client_factory=client_factory,
+        )
+    raise ValueError(f"Unknown part2 mode {mode!r}")
+
+
+def prepare_publish_case(mode, store_dir, work_dir):
+    import pandas as pd
+
+    import Part2
+
+    service = LocalBlobServiceClient(store_dir)
+    Part2.get_blob_service_client = lambda *args, **kwargs: service
+    country_avg_rate = pd.DataFrame({"Country": COUNTRIES, "Rating": 3.0})
+    top_3_categories = pd.DataFrame({"Category": CATEGORIES[:3], "Rating": 3.0})
+    result_file_name = os.path.join(work_dir, "Wenkui-Tian.csv")
+
+    if mode == "file":
+
+        def publish():
+            Part2.save_result_to_csv(
+                country_avg_rate, top_3_categories, result_file_name
+            )
+            Part2.save_file_to_azure_storage(
+                ACCOUNT_URL, None, "results", USER_CONTAINER, result_file_name
+            )
+            # Counted once, not for both the save and the upload
+            return {"bytes": os.path.getsize(result_file_name)}
+
+        return publish
+    container_client = service.get_container_client(USER_CONTAINER)
+    return lambda: Part2.upload_result(
+        container_client,
+        "results",
+        "Wenkui-Tian.csv",
+        Part2.serialize_result(country_avg_rate, top_3_categories),
+        gzip_encoding=mode == "gzip",
+    )
+
+
+def prepare_part1q3_case(mode, store_dir, work_dir):
+    import Part1Q3
+
+    service = LocalBlobServiceClient(work_dir)
+    container_client = service.get_container_client("uploads")
+    container_client.create_container()
+    dataset_path = os.path.join(store_dir, RAW_CONTAINER, "tourism_dataset.csv")
+    blob_client = container_client.get_blob_client("tourism_dataset.csv")
+
+    if mode == "single":
+
+        def upload():
+            Part1Q3.upload_file(blob_client, dataset_path)
+            return {"bytes": os.path.getsize(dataset_path)}
+
+        return upload
+    if mode == "blocks":
+        shutil.rmtree(blob_client.staging_dir, ignore_errors=True)
+        return lambda: {
+            "bytes": Part1Q3.upload_file_in_blocks(blob_client, dataset_path)
+        }
+    if mode == "sync":
+        # Every part is new to the destination
+        shutil.rmtree(os.path.join(work_dir, "uploads", "sync"), ignore_errors=True)
+        parts_dir = os.path.join(store_dir, RAW_CONTAINER, "parts")
+
+        def sync():
+            Part1Q3.sync_directory(container_client, "*.csv", parts_dir, "sync/")
+            return {
+                "bytes": sum(entry.stat().st_size for entry in os.scandir(parts_dir))
+            }
+
+        return sync
+    raise ValueError(f"Unknown part1q3 mode {mode!r}")
+
+
+def prepare_part1q4_case(mode, events, work_dir, page_latency):
+    import Part1Q4
+
+    if mode == "parquet" and Part1Q4.pq is None:
+        return None
+    end_time = events.end_time
+    start_time = end_time - timedelta(days=1)
+    monitor_client = SimpleNamespace(
+        activity_logs=Part1Q4.RecordedActivityLogs(
+            events.logs, page_latency=page_latency
+        )
+    )
+    output_file = os.path.join(
+        work_dir, "activity_logs.parquet" if mode == "parquet" else "activity_logs.csv"
+    )
+
+    def export():
+        if mode == "parallel":
+            activity_logs = Part1Q4.export_activity_logs_parallel(
+                monitor_client, start_time, end_time, "vm", windows=4, workers=4
+            )
+        else:
+            activity_logs = Part1Q4.fetch_activity_logs(
+                monitor_client, start_time, end_time, "vm"
+            )
+        output_format = "parquet" if mode == "parquet" else "csv"
+        rows = Part1Q4.write_logs(activity_logs, output_file, output_format)
+        return {"rows": rows, "bytes": os.path.getsize(output_file)}
+
+    return export
+
+
+def prepare_case(suite, mode, size, options, work_dir):
+    # Datasets are generated by the parent process before the cases run
+    if suite == "part2":
+        store_dir = generate_dataset(options.data_dir, size)
+        return prepare_part2_case(mode, store_dir, work_dir, options.processes)
+    if suite == "publish":
+        return prepare_publish_case(mode, work_dir, work_dir)
+    if suite == "part1q3":
+        store_dir = generate_dataset(options.data_dir, size)
+        return prepare_part1q3_case(mode, store_dir, work_dir)
+    end_time = datetime(2026, 1, 2, tzinfo=timezone.utc)
+    events = SimpleNamespace(
+        logs=synthetic_activity_logs(size, end_time), end_time=end_time
+    )
+    return prepare_part1q4_case(mode, events, work_dir, options.page_latency)
+
+
+def measure_case(suite, mode, size, options):
+    """
+    Runs the repeats of one case, in a fresh child process so peak RSS is measured
+    per case. The rows and bytes are those recorded by the pipeline's own
+    instrumentation.
+    """
+    work_dir = os.path.join(options.data_dir, "work", f"{suite}-{mode}-{size}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    start_run(f"{suite}-{mode}")
+
+    timings = []
+    metrics = {}
+    for repeat in range(options.warmup + options.repeats):
+        run = prepare_case(suite, mode, size, options, work_dir)
+        if run is None:
+            return None
+        with contextlib.redirect_stdout(io.StringIO()):
+            with stage(mode) as metrics:
+                counts = run()
+        if isinstance(counts, dict):
+            metrics.update(counts)
+        if repeat >= options.warmup:
+            timings.append(metrics["wall"])
+
+    return {
+        "timings": timings,
+        "rows": metrics.get("rows", 0),
+        "bytes": metrics.get("bytes", 0),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def benchmark_case(suite, mode, size, options):
+    measured = run_isolated(
+        measure_case, (suite, mode, size, options), f"{suite} {mode} size={size}"
+    )
+    if measured is None:
+        return None
+
+    summary = summarize_timings(measured["timings"])
+    median = summary["median"]
+    return {
+        "suite": suite,
+        "mode": mode,
+        "size": size,
+        **summary,
+        "rows": measured["rows"],
+        "bytes": measured["bytes"],
+        "rows_per_s": measured["rows"] / median if median else 0.0,
+        "mb_per_s": measured["bytes"] / (1024 * 1024) / median if median else 0.0,
+        "peak_rss_mb": measured["peak_rss_mb"],
+    }
+
+
+def case_key(result):
+    return result["suite"], result["mode"], result["size"]
+
+
+def load_history(path):
+    # Latest previous result of every case
+    latest = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                latest[case_key(result)] = result
+    return latest
+
+
+def append_history(results, path, label):
+    run = {
+        "label": label,
+        "run_id": hashlib.sha1(f"{label}{time.time()}".encode()).hexdigest()[:12],
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": mp.cpu_count(),
+    }
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps({**run, **result}) + "\n")
+    print(f"{len(results)} results appended to {path}")
+
+
+def run_benchmarks(options):
+    previous = load_history(options.history)
+    results = []
+    for suite in options.suites:
+        sizes = {
+            "publish": [0],
+            "part1q4": options.events,
+        }.get(suite, options.sizes)
+        for size in sizes:
+            if suite in ("part2", "part1q3"):
+                generate_dataset(options.data_dir, size)
+            for mode in SUITES[suite]:
+                result = benchmark_case(suite, mode, size, options)
+                if result is None:
+                    print(f"{suite:>8} {mode:>11} skipped (optional dependency)")
+                    continue
+                result["label"] = options.label
+                old = previous.get(case_key(result))
+                change = ""
+                if old:
+                    ratio = result["median"] / old["median"] - 1
+                    change = f" ({ratio:+.0%} vs {old['label']})"
+                print(
+                    f"{suite:>8} {mode:>11} size={size:<11} "
+                    f"median={result['median']:.3f}s{change} "
+                    f"rows/s={result['rows_per_s']:,.0f} "
+                    f"MB/s={result['mb_per_s']:.1f} "
+                    f"rss={result['peak_rss_mb']:.0f}MB"
+                )
+                results.append(result)
+    regressions = find_regressions(results, previous, case_key, options.threshold)
+    return results, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline offline against local Azure stand-ins."
+    )
+    parser.add_argument("--suites", default=",".join(SUITES))
+    parser.add_argument(
+        "--sizes",
+        type=parse_int_list,
+        default=[10**5, 10**6],
+        help="dataset rows, e.g. 1e5,1e6,1e7,1e8",
+    )
+    parser.add_argument(
+        "--events",
+        type=parse_int_list,
+        default=[10**4, 10**5],
+        help="activity log events for the part1q4 suite",
+    )
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument(
+        "--start-method",
+        choices=mp.get_all_start_methods(),
+        default=None,
+        help="multiprocessing start method, the platform default when not set",
+    )
+    parser.add_argument("--page-latency", type=float, default=0.0)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--data-dir", default=".benchmark_data")
+    parser.add_argument("--history", default="benchmark_history.jsonl")
+    parser.add_argument("--label", default="local", help="version or commit label")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="allowed slowdown of the median before a case counts as a regression",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with an error when a case regressed against the history",
+    )
+    options = parser.parse_args()
+    options.suites = options.suites.split(",")
+    if options.start_method:
+        mp.set_start_method(options.start_method)
+
+    results, regressions = run_benchmarks(options)
+    append_history(results, options.history, options.label)
+
+    for result, old in regressions:
+        print(
+            f"Regression: {result['suite']} {result['mode']} size={result['size']} "
+            f"median {old['median']:.3f}s -> {result['median']:.3f}s"
+        )
+    if regressions and options.check:
+        sys.exit(1)